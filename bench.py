@@ -7,6 +7,7 @@ import numpy as np
 import time
 import torch
 from model import GPTConfig, GPT
+from loader import BatchLoader
 
 # -----------------------------------------------------------------------------
 batch_size = 12
@@ -34,13 +35,8 @@ if real_data:
     dataset = 'openwebtext'
     data_dir = os.path.join('data', dataset)
     train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    def get_batch(split):
-        data = train_data # note ignore split in benchmarking script
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-        return x, y
+    train_loader = BatchLoader(train_data, batch_size, block_size, device)
+    get_batch = lambda split: train_loader.next() # note ignore split in benchmarking script
 else:
     # alternatively, if fixed data is desired to not care about data loading
     x = torch.randint(50304, (batch_size, block_size), device=device)
@@ -99,6 +95,8 @@ else:
     torch.cuda.synchronize()
     for stage, num_steps in enumerate([10, 20]): # burnin, then benchmark
         t0 = time.time()
+        if real_data:
+            train_loader.pop_wait()
         X, Y = get_batch('train')
         for k in range(num_steps):
             with ctx:
@@ -113,3 +111,5 @@ else:
         t1 = time.time()
         if stage == 1:
             print(f"time per iteration: {(t1-t0)/num_steps*1000:.4f}ms")
+            if real_data:
+                print(f"data wait per iteration: {train_loader.pop_wait()/num_steps*1000:.4f}ms")
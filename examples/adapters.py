@@ -0,0 +1,92 @@
+"""
+Serve many LoRA adapters from one base model.
+
+Every c_attn keeps the shared base weight and a bank of low-rank adapters stacked into tensors.
+Each row of a batch selects its adapter, so requests for different tasks (pos, ner, gec, spell)
+are batched together and the memory grows by the size of the adapters only.
+Adapter 0 is the base model itself.
+
+    adapters = Adapters(model)
+    pos = adapters.load('pos', checkpoints.load('exp/pos/ckpt.pt')['model'])
+    ner = adapters.load('ner', checkpoints.load('exp/ner/ckpt.pt')['model'])
+    adapters.select(torch.tensor([pos, ner, 0]))
+    y, _ = model(x) # x has three rows
+"""
+import sys
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from merge_lora import strip_peft_prefix
+
+
+class MultiLoraLinear(nn.Module):
+    "nn.Linear with a delta x @ A.T @ B.T * scaling picked per batch row from a bank of adapters"
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        # adapter 0 has no delta
+        self.register_buffer('lora_A', base.weight.new_zeros((1, 1, base.in_features)))
+        self.register_buffer('lora_B', base.weight.new_zeros((1, base.out_features, 1)))
+        self.register_buffer('scaling', base.weight.new_zeros((1,)))
+        self.adapter_ids = None # LongTensor (B,) set by Adapters.select
+
+    def add(self, A, B, scaling):
+        "append an adapter, ranks may differ: the bank is padded with zeros to the largest one"
+        r = max(self.lora_A.size(1), A.size(0))
+        A = F.pad(A.to(self.lora_A), (0, 0, 0, r - A.size(0)))
+        B = F.pad(B.to(self.lora_B), (0, r - B.size(1)))
+        self.lora_A = torch.cat([F.pad(self.lora_A, (0, 0, 0, r - self.lora_A.size(1))), A[None]])
+        self.lora_B = torch.cat([F.pad(self.lora_B, (0, r - self.lora_B.size(2))), B[None]])
+        self.scaling = torch.cat([self.scaling, self.scaling.new_tensor([scaling])])
+
+    def forward(self, x):
+        y = self.base(x)
+        if self.adapter_ids is None:
+            return y
+        A = self.lora_A[self.adapter_ids] # (B, r, in)
+        B = self.lora_B[self.adapter_ids] * self.scaling[self.adapter_ids, None, None] # (B, out, r)
+        return y + (x @ A.transpose(1, 2)) @ B.transpose(1, 2)
+
+
+class Adapters:
+    "Replaces every c_attn of model with a MultiLoraLinear and keeps track of the loaded adapters."
+
+    def __init__(self, model, target_module='c_attn'):
+        self.target_module = target_module
+        self.layers = {}
+        for name, module in list(model.named_modules()):
+            if name.endswith(target_module) and isinstance(module, nn.Linear):
+                parent = model.get_submodule(name.rpartition('.')[0])
+                self.layers[name] = MultiLoraLinear(module)
+                setattr(parent, target_module, self.layers[name])
+        if not self.layers:
+            raise ValueError(f'{target_module} not found in the model')
+        self.names = ['base']
+
+    def load(self, name, state_dict, lora_alpha=32):
+        """
+        Add the adapter tensors of a LoRA checkpoint state dict, the rest of the checkpoint is ignored.
+        Returns the adapter id to pass to select.
+        """
+        state_dict = strip_peft_prefix(state_dict)
+        same_base = True
+        for key, layer in self.layers.items():
+            A, B = state_dict[key + '.lora_A.weight'], state_dict[key + '.lora_B.weight']
+            same_base = same_base and torch.equal(state_dict[key + '.weight'].to(layer.base.weight), layer.base.weight)
+            layer.add(A, B, lora_alpha / A.size(0))
+        if not same_base:
+            print(f'WARNING: adapter {name} was trained on top of different {self.target_module} weights than the base model', file=sys.stderr)
+        self.names.append(name)
+        return len(self.names) - 1
+
+    def select(self, adapter_ids):
+        "LongTensor (B,) of adapter ids for every row of the next batch, None to run the base model"
+        for layer in self.layers.values():
+            layer.adapter_ids = adapter_ids if adapter_ids is None else adapter_ids.to(layer.lora_A.device)
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for layer in self.layers.values()
+                   for t in (layer.lora_A, layer.lora_B, layer.scaling))
@@ -16,7 +16,10 @@ import torch.nn.functional as F
 
 import sentencepiece as spm
 from model import GPTConfig, GPT
-from lora import gpt2_peft_config, lora_find_and_replace
+import inference
+import checkpoints
+from logits_processors import LogitsProcessor
+from merge_lora import has_lora
 from torch.nn.utils.rnn import pad_sequence
 
 
@@ -45,6 +48,12 @@ parser.add_argument('--device', type=str, default='cuda:0')
 
 parser.add_argument('--seq_len', type=int, default=128, help='input sequence length (including context)')
 
+parser.add_argument('--no_kv_cache', action='store_true', help='re-encode the full query window at every step instead of decoding against the key/value cache')
+
+parser.add_argument('--prefix_cache', action='store_true', help='encode the context once per run and share its key/value cache between all queries')
+
+inference.add_arguments(parser)
+
 parser.add_argument('ckpt_path', type=Path)
 parser.add_argument('context', help='data to use as padding context', type=Path)
 parser.add_argument('data', help='paragraphs', type=Path)
@@ -56,119 +65,76 @@ def _reorder_cache(past: Tuple, beam_idx: Tensor) -> Tuple[Tensor]:
     return tuple(layer_past.index_select(1, beam_idx).contiguous().detach() for layer_past in past)
 
 
-def _calc_banned_ngram_tokens(
-    prev_input_ids: Tensor, 
-    num_hypos: int, 
-    no_repeat_ngram_size: int, 
-    cur_len: int
-) -> None:
-    """Copied from fairseq for no_repeat_ngram in beam_search"""
-    if cur_len + 1 < no_repeat_ngram_size:
-        # return no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-        return [[] for _ in range(num_hypos)]
-    
-    generated_ngrams = [{} for _ in range(num_hypos)]
-    for idx in range(num_hypos):
-        gen_tokens = prev_input_ids[idx].tolist()
-        generated_ngram = generated_ngrams[idx]
-        for ngram in zip(*[gen_tokens[i:] for i in range(no_repeat_ngram_size)]):
-            prev_ngram_tuple = tuple(ngram[:-1])
-            generated_ngram[prev_ngram_tuple] = generated_ngram.get(prev_ngram_tuple, []) + [ngram[-1]]
-
-    def _get_generated_ngrams(hypo_idx):
-        # Before decoding the next token, prevent decoding of ngrams that have already appeared
-        start_idx = cur_len + 1 - no_repeat_ngram_size
-        ngram_idx = tuple(prev_input_ids[hypo_idx, start_idx:cur_len].tolist())
-        return generated_ngrams[hypo_idx].get(ngram_idx, [])
-
-    banned_tokens = [_get_generated_ngrams(hypo_idx) for hypo_idx in range(num_hypos)]
-    return banned_tokens
-
-
-def _enforce_repetition_penalty_(
-    lprobs, 
-    batch_size, 
-    num_beams, 
-    prev_output_tokens, 
-    repetition_penalty
-):
-    """repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858). """
-
-    for i in range(batch_size * num_beams):
-        for previous_token in set(prev_output_tokens[i].tolist()):
-            # if score < 0 then repetition penalty has to multiplied to reduce the previous token probability
-            if lprobs[i, previous_token] < 0:
-                lprobs[i, previous_token] *= repetition_penalty
-            else:
-                lprobs[i, previous_token] /= repetition_penalty
-
-def _postprocess_next_token_scores(
-    scores,
-    history,
-    cur_len,
-    batch_size,
-    num_beams,
-    repetition_penalty=1.0,                                
-    no_repeat_ngram_size=4,
-    bad_words_ids=None,
-    min_length=0,
-    max_length=100,
-    eos_token_id=None,
-):
-    # repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858)
-    if repetition_penalty != 1.0 and history is not None:
-        _enforce_repetition_penalty_(scores, batch_size, num_beams, history, repetition_penalty)
-
-    # score: batch_size * beam, vocab
-    # set eos token prob to zero if min_length is not reached
-    if eos_token_id is not None and cur_len < min_length:
-        for eos in eos_token_id:
-            scores[:, eos] = -float("inf")
-
-    if no_repeat_ngram_size > 0 and history is not None:
-        # calculate a list of banned tokens to prevent repetitively generating the same ngrams
-        num_batch_hypotheses = batch_size * num_beams
-        # from fairseq: https://github.com/pytorch/fairseq/blob/a07cb6f40480928c9e0548b737aadd36ee66ac76/fairseq/sequence_generator.py#L345
-        banned_batch_tokens = _calc_banned_ngram_tokens(
-                history, num_batch_hypotheses, no_repeat_ngram_size, cur_len
-        )
-
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
-
-    return scores
-
-
 def _add_beam_candidate(
     best_score, 
+    has_best, 
     best_sequence, 
-    batch_size, 
+    active, 
     num_beams, 
     beam_scores, 
     history, 
+    length_penalty, 
+    max_len, 
     eos_token_id=None
 ):
-    last_tokens = history[:, -1]
-    for _i in range(batch_size * num_beams):
-        if eos_token_id is None or last_tokens[_i] in eos_token_id:
-            cur_len = history.shape[-1]
-            _score = beam_scores.view(-1)[_i] / cur_len ** args.length_penalty
+    """
+    Offer hypotheses that end with eos_token_id (all of them when it is None) as candidates
+    for their batch items in active, keeping the best candidate of every item in the
+    preallocated best_score, has_best and best_sequence. Offered hypotheses are not extended further.
+
+    Returns a bool mask over active items that can no longer improve on their best candidate:
+    log probabilities only decrease, so no running hypothesis can end with a better score.
+    """
+    cur_len = history.shape[-1]
+    if eos_token_id is None:
+        finished = torch.ones_like(beam_scores, dtype=torch.bool)
+    else:
+        finished = torch.isin(history[:, -1], eos_token_id).view_as(beam_scores) # batch_size, num_beams
 
-            batch_id = _i // num_beams
+    _score = (beam_scores / cur_len ** length_penalty).masked_fill(~finished, -float("inf"))
+    top_score, top_beam = _score.max(dim=1)
 
-            if not batch_id in best_score or best_score[batch_id] < _score:
-                best_score[batch_id] = _score
-                best_sequence[batch_id][:cur_len] = history[_i]
+    _best_score, _has_best = best_score[active], has_best[active]
+    better = finished.any(dim=1) & (~_has_best | (top_score > _best_score))
+    best_score[active] = torch.where(better, top_score, _best_score)
+    has_best[active] = _has_best | better
 
-            beam_scores.view(-1)[_i] = -float("inf")
+    _batch = torch.arange(active.size(0), device=active.device)
+    candidate = history.view(active.size(0), num_beams, -1)[_batch, top_beam] # batch_size, cur_len
+    best_sequence[active, :cur_len] = torch.where(better.unsqueeze(-1), candidate, best_sequence[active, :cur_len])
+
+    beam_scores.masked_fill_(finished, -float("inf"))
+
+    # the best score a running hypothesis may still reach: with a positive length penalty
+    # its score keeps improving with length, otherwise it is best right now
+    bound_len = max_len if length_penalty > 0 else cur_len
+    bound = beam_scores.max(dim=1).values / bound_len ** length_penalty
+    return has_best[active] & (best_score[active] >= bound)
 
 
 @torch.inference_mode()
-def beam(model, data_iter, args, eos_token_id=[50256]):
+def beam(model, data_iter, args, eos_token_id=[50256], context=None):
     model.eval()
     total_loss = 0.
     start_time = time.time()
 
+    eos_token_id = torch.tensor(eos_token_id, device=args.device)
+
+    process_logits = LogitsProcessor(
+        repetition_penalty=args.repetition_penalty,
+        no_repeat_ngram_size=args.no_repeat_ngram_size,
+        min_length=args.min_length,
+        eos_token_id=eos_token_id,
+    )
+
+    prefix = None
+    if context is not None:
+        # every query continues the same context: encode it once and broadcast its cache over all rows
+        with inference.autocast(args.device, dtype=torch.float16):
+            _, _, prefix = model(context.to(args.device)[None, :], use_cache=True)
+
+    throughput = inference.Throughput(args.device)
+
     all_predictions = {}
     for idx, data in enumerate(data_iter):
         data = {key: value for key, value in data.items()}
@@ -189,15 +155,20 @@ def beam(model, data_iter, args, eos_token_id=[50256]):
         num_beams = args.beam
         length_penalty = args.length_penalty
 
-        _batch = torch.arange(0, _id.size(0), device=args.device, dtype=torch.long)
-        
         kv_cache = None
-        len_kv_cache = None
 
+        attention_mask = None
+        if prefix is not None:
+            # queries following the shared prefix are left padded to the longest one in the batch
+            attention_mask = torch.arange(_query.size(1), device=args.device) >= (_query.size(1) - _query_len).unsqueeze(-1)
+
+        # all beams start from the same query, the cache is filled once per batch item
+        _prefill = _query
         _query = _query.repeat(1, num_beams).view(batch_size * num_beams, -1)
         _query_len = _query_len.unsqueeze(-1).repeat(1, num_beams).view(-1)
 
-        _bbatch = _batch.unsqueeze(-1).repeat(1, num_beams).view(-1)
+        # batch items that are still being decoded, finished items are dropped from all per-row state
+        _active = torch.arange(0, batch_size, device=args.device, dtype=torch.long)
         
         # scores for each sentence in the beam
         beam_scores = torch.zeros(
@@ -207,34 +178,36 @@ def beam(model, data_iter, args, eos_token_id=[50256]):
         best_sequence = torch.zeros(
             (batch_size, args.eval_len), dtype=torch.long, device=_query.device
         )
-        best_score = {}
+        best_score = torch.full(
+            (batch_size,), -float("inf"), dtype=torch.float, device=_query.device
+        )
+        has_best = torch.zeros(
+            (batch_size,), dtype=torch.bool, device=_query.device
+        )
 
         history = None
         for i in range(0, args.eval_len):
-            with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
-                if i == 0:
-                    logits, kv_cache = model(_query, attention_mask=make_padded_causal_masks(_query_len + i))[0], None
-                    logits = logits[:, -1, :] # batch_size * beam, vocab
+            num_active = _active.size(0)
+            with inference.autocast(args.device, dtype=torch.float16):
+                if args.no_kv_cache:
+                    throughput.add(_query.numel())
+                    logits = model(_query, attention_mask=make_padded_causal_masks(_query_len + i))[0]
+                elif i == 0:
+                    throughput.add(_prefill.numel())
+                    logits, _, kv_cache = model(_prefill, attention_mask=attention_mask, prefix=prefix, use_cache=True)
+                    logits = logits.repeat_interleave(num_beams, dim=0)
+                    kv_cache = tuple(layer_past.repeat_interleave(num_beams, dim=1) for layer_past in kv_cache)
+                    if attention_mask is not None:
+                        attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
                 else:
-                    #print('token_id.shape', token_id.shape, token_id)
-                    #print('past.shape', past[0].shape)
-                    #print('len_past.shape', len_past.shape, len_past)
-
-                    #logits, kv_cache = model(token_id, past=kv_cache, len_past=len_kv_cache), None
-                    logits, kv_cache = model(_query, attention_mask=make_padded_causal_masks(_query_len + i))[0], None
-                    logits = logits[:, -1, :]    # batch_size * beam, vocab
-
-            logits = _postprocess_next_token_scores(           
-                logits,
-                history,
-                i,
-                batch_size,
-                num_beams,
-                repetition_penalty=args.repetition_penalty,                                
-                no_repeat_ngram_size=args.no_repeat_ngram_size,
-                min_length=args.min_length,
-                eos_token_id=eos_token_id,
-            )
+                    # only the tokens chosen at the previous step are new, everything else is in the cache
+                    if attention_mask is not None:
+                        attention_mask = torch.cat((attention_mask, attention_mask.new_ones(attention_mask.size(0), 1)), dim=1)
+                    throughput.add(token_id.numel())
+                    logits, _, kv_cache = model(token_id, past=kv_cache, attention_mask=attention_mask, prefix=prefix, use_cache=True)
+                logits = logits[:, -1, :] # batch_size * beam, vocab
+
+            logits = process_logits(logits, history)
 
             softmax_probs = F.softmax(logits, dim=-1)
             ##_prob, _w_idx = torch.topk(softmax_probs, num_beams) # batch_size, beam
@@ -244,10 +217,10 @@ def beam(model, data_iter, args, eos_token_id=[50256]):
 
             _logprob = torch.log(softmax_probs) # batch_size * beam, vocab
             if i == 0:
-                next_scores = _logprob.view(batch_size, num_beams, -1)[:, 0, :] # batch_size, vocab
+                next_scores = _logprob.view(num_active, num_beams, -1)[:, 0, :] # batch_size, vocab
             else:
-                next_scores = beam_scores.unsqueeze(-1) + _logprob.view(batch_size, num_beams, -1)
-                next_scores = next_scores.view(batch_size, -1) # batch_size, beam * vocab
+                next_scores = beam_scores.unsqueeze(-1) + _logprob.view(num_active, num_beams, -1)
+                next_scores = next_scores.view(num_active, -1) # batch_size, beam * vocab
 
             next_scores, next_tokens = torch.topk(
                 next_scores, num_beams, dim=1, largest=True, sorted=True
@@ -256,25 +229,42 @@ def beam(model, data_iter, args, eos_token_id=[50256]):
             beam_id = (next_tokens // vocab_size).view(-1)    # batch_size * num_beams
             token_id = (next_tokens % vocab_size).view(-1).unsqueeze(-1) # batch_size, num_beams
 
-            beam_idx = beam_id.view(batch_size, num_beams) + (_batch * num_beams).unsqueeze(-1)
+            _batch = torch.arange(0, num_active, device=args.device, dtype=torch.long)
+            beam_idx = beam_id.view(num_active, num_beams) + (_batch * num_beams).unsqueeze(-1)
             kv_cache = _reorder_cache(kv_cache, beam_idx.view(-1))                
             beam_scores = next_scores # batch_size, num_beams
-            len_kv_cache = (_query_len + i).long()
 
             if history is None:
                 history = token_id.detach()
             else:
                 history = torch.cat((history[beam_idx.view(-1)], token_id), dim=1)
 
-            _query = torch.cat((_query[beam_idx.view(-1)], token_id), dim=1)[:, -args.seq_len:]
+            if args.no_kv_cache:
+                _query = torch.cat((_query[beam_idx.view(-1)], token_id), dim=1)[:, -args.seq_len:]
 
-            _add_beam_candidate(
-                best_score, best_sequence, batch_size, num_beams, beam_scores, history, 
-                eos_token_id=eos_token_id
+            done = _add_beam_candidate(
+                best_score, has_best, best_sequence, _active, num_beams, beam_scores, history, 
+                length_penalty, args.eval_len, eos_token_id=eos_token_id
             )
+
+            if done.any():
+                if done.all():
+                    break
+                keep = (~done).nonzero().squeeze(-1)
+                rows = (keep.unsqueeze(-1) * num_beams + torch.arange(num_beams, device=args.device)).view(-1)
+                _active = _active[keep]
+                beam_scores = beam_scores[keep]
+                history = history[rows]
+                token_id = token_id[rows]
+                kv_cache = _reorder_cache(kv_cache, rows)
+                if attention_mask is not None:
+                    attention_mask = attention_mask[rows]
+                _query = _query[rows]
+                _query_len = _query_len[rows]
         
         _add_beam_candidate(
-            best_score, best_sequence, batch_size, num_beams, beam_scores, history
+            best_score, has_best, best_sequence, _active, num_beams, beam_scores, history, 
+            length_penalty, args.eval_len
         )
 
         output = best_sequence
@@ -290,10 +280,13 @@ def beam(model, data_iter, args, eos_token_id=[50256]):
             all_predictions[_i]['predict'] = output[_b].tolist()
             #all_predictions[_i]['score'] = score[_b].tolist()
 
-            skip = args.seq_len - data['query_len'][_b] # skip context
+            skip = data['query'].size(1) - data['query_len'][_b] # skip context or padding
             print(sp.decode(data['query'][_b].tolist()[skip:] + output[_b].tolist()))
             print(flush=True)
 
+    throughput.report()
+    return all_predictions
+
 
 def make_padded_causal_masks(query_len, _enabled=False):
     if not _enabled: # global kludge
@@ -314,6 +307,7 @@ def make_padded_causal_masks(query_len, _enabled=False):
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    inference.setup(args)
     
     sp = spm.SentencePieceProcessor(model_file=args.spm)
     
@@ -333,6 +327,27 @@ if __name__ == '__main__':
     
     paragraphs = args.data.read_text().split("\n\n")
     valid_data = [tokenize(i, paragraph) for i, paragraph in enumerate(paragraphs)]
+
+    if args.prefix_cache:
+        if args.no_kv_cache:
+            parser.error('--prefix_cache needs the key/value cache, drop --no_kv_cache')
+        longest = max(b['query_len'] for b in valid_data)
+        if longest >= args.seq_len:
+            parser.error(f'--prefix_cache needs --seq_len longer than the longest query ({longest} tokens)')
+        # keep as much of the context as the longest query leaves room for
+        context_data = context_data[-(args.seq_len - longest):]
+
+    def collate_prefix(batch):
+        # context is cached separately, left pad the queries to the longest one in the batch
+        x = {
+            'query': pad_sequence([
+                torch.LongTensor(b['query']).flip(0)
+                for b in batch
+            ], batch_first=True, padding_value=50256).flip(1),
+            'query_len': torch.LongTensor([b['query_len'] for b in batch]),
+            'id': torch.LongTensor([b['id'] for b in batch]),
+        }
+        return x
     
     def collate(batch):
         x = {
@@ -347,21 +362,31 @@ if __name__ == '__main__':
 
     valid_loader = DataLoader(
         valid_data,
-        batch_size=args.batch_size, collate_fn=collate,
+        batch_size=args.batch_size, collate_fn=collate_prefix if args.prefix_cache else collate,
         num_workers=0, shuffle=False, 
         pin_memory=False, drop_last=False,
     )
 
-    checkpoint = torch.load(args.ckpt_path, map_location=args.device)
+    checkpoint = checkpoints.load(args.ckpt_path)
 
     # model
     gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-
-    lora_find_and_replace(model, gpt2_peft_config)
-    model.load_state_dict(checkpoint['model'])
+    lora = has_lora(checkpoint['model'])
+    if lora:
+        model = GPT(gptconf)
+        from lora import gpt2_peft_config, lora_find_and_replace
+        lora_find_and_replace(model, gpt2_peft_config)
+        model.load_state_dict(checkpoint['model'])
+    else:
+        model = checkpoints.build_model(gptconf, checkpoint['model'])
     model.eval()
     model.to(args.device)
-    #model = torch.compile(model) # CUDA error: an illegal memory access was encountered
 
-    beam(model, valid_loader, args)
+    if not args.no_kv_cache and args.seq_len + args.eval_len > gptconf.block_size:
+        # the cache keeps every position, it cannot slide the window like the re-encoding path
+        parser.error(f'--seq_len + --eval_len must fit into block_size {gptconf.block_size} with the key/value cache, pass --no_kv_cache')
+    if not lora and inference.should_compile(args):
+        # LoRA layers fail to compile: CUDA error: an illegal memory access was encountered, merge them with merge_lora.py
+        model = torch.compile(model) # requires PyTorch 2.0
+
+    beam(model, valid_loader, args, context=context_data if args.prefix_cache else None)
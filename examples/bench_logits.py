@@ -0,0 +1,104 @@
+"""
+Microbenchmark of the per-step overhead of logits processing in beam search as the batch grows.
+
+Compares the batched LogitsProcessor against the per-hypothesis python loops beam.py used before,
+and checks that both produce the same scores.
+
+$ python -m bench_logits --device cuda:0 --batch_sizes 1 64 768 --beam 2
+"""
+import argparse
+import time
+
+import torch
+
+from logits_processors import LogitsProcessor
+
+
+parser = argparse.ArgumentParser('bench_logits')
+parser.add_argument('--device', type=str, default='cuda:0')
+parser.add_argument('--seed', type=int, default=1337)
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 64, 256, 768])
+parser.add_argument('--beam', type=int, default=2, help='beam search size')
+parser.add_argument('--cur_len', type=int, default=32, help='tokens generated so far')
+parser.add_argument('--vocab_size', type=int, default=50257)
+parser.add_argument('--no_repeat_ngram_size', type=int, default=2)
+parser.add_argument('--repetition_penalty', type=float, default=1.2)
+parser.add_argument('--min_length', type=int, default=64)
+parser.add_argument('--steps', type=int, default=10, help='timed steps per batch size')
+parser.add_argument('--skip_reference', action='store_true', help='only time the batched processor')
+
+
+def reference(scores, history, repetition_penalty, no_repeat_ngram_size, min_length, eos_token_id):
+    "per-hypothesis loops from fairseq and CTRL as previously used by beam.py"
+    num_hypos, cur_len = history.shape
+    for i in range(num_hypos):
+        for previous_token in set(history[i].tolist()):
+            if scores[i, previous_token] < 0:
+                scores[i, previous_token] *= repetition_penalty
+            else:
+                scores[i, previous_token] /= repetition_penalty
+
+    if cur_len < min_length:
+        for eos in eos_token_id:
+            scores[:, eos] = -float("inf")
+
+    if cur_len + 1 < no_repeat_ngram_size:
+        return scores
+    for i in range(num_hypos):
+        gen_tokens = history[i].tolist()
+        generated_ngram = {}
+        for ngram in zip(*[gen_tokens[j:] for j in range(no_repeat_ngram_size)]):
+            generated_ngram.setdefault(tuple(ngram[:-1]), []).append(ngram[-1])
+        start_idx = cur_len + 1 - no_repeat_ngram_size
+        banned_tokens = generated_ngram.get(tuple(history[i, start_idx:cur_len].tolist()), [])
+        scores[i, banned_tokens] = -float("inf")
+    return scores
+
+
+def timed(fn, steps, device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    eos_token_id = [50256]
+
+    process_logits = LogitsProcessor(
+        repetition_penalty=args.repetition_penalty,
+        no_repeat_ngram_size=args.no_repeat_ngram_size,
+        min_length=args.min_length,
+        eos_token_id=eos_token_id,
+    )
+
+    print('hypotheses', 'batched_ms', 'reference_ms', 'speedup', 'match', sep='\t')
+    for batch_size in args.batch_sizes:
+        num_hypos = batch_size * args.beam
+        scores = torch.randn(num_hypos, args.vocab_size, device=args.device)
+        # a small alphabet makes repeated ngrams likely
+        history = torch.randint(0, 64, (num_hypos, args.cur_len), device=args.device)
+
+        process_logits(scores.clone(), history) # warmup
+        batched = timed(lambda: process_logits(scores.clone(), history), args.steps, args.device)
+
+        if args.skip_reference:
+            print(num_hypos, f'{batched*1000:.3f}', '-', '-', '-', sep='\t', flush=True)
+            continue
+
+        reference_steps = max(1, args.steps // 10)
+        looped = timed(lambda: reference(scores.clone(), history, args.repetition_penalty,
+                                         args.no_repeat_ngram_size, args.min_length, eos_token_id),
+                       reference_steps, args.device)
+        match = torch.equal(
+            process_logits(scores.clone(), history),
+            reference(scores.clone(), history, args.repetition_penalty,
+                      args.no_repeat_ngram_size, args.min_length, eos_token_id),
+        )
+        print(num_hypos, f'{batched*1000:.3f}', f'{looped*1000:.3f}', f'{looped/batched:.1f}x', match, sep='\t', flush=True)
@@ -0,0 +1,93 @@
+"""
+Background checkpoint writer for the training loops.
+
+save() copies the tensors of a checkpoint into pinned host memory and returns, the training loop
+continues while a thread waits for the copies, serializes them into path + '.tmp' and renames that over path,
+so path always holds a complete checkpoint. With keep > 1 the checkpoint of every step is also kept
+as <stem>.step<step><suffix>, a hard link to the same file, and only the keep most recent of them stay on disk.
+One checkpoint is written at a time, the host buffers are reused by the next checkpoint of the same layout.
+"""
+import glob
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+
+import torch
+
+
+class CheckpointWriter:
+
+    def __init__(self, keep=1):
+        self.keep = keep
+        self.buffers = []
+        self.thread = None
+        self.error = None
+
+    def _snapshot(self, obj, used, memo):
+        if torch.is_tensor(obj):
+            # tensors sharing memory, like tied embeddings, share their copy as well
+            key = (obj.data_ptr(), obj.shape, obj.stride(), obj.dtype, obj.device)
+            if key in memo:
+                return memo[key]
+            buffer = self.buffers[len(used)] if len(used) < len(self.buffers) else None
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=torch.cuda.is_available())
+            buffer.copy_(obj.detach(), non_blocking=True)
+            used.append(buffer)
+            memo[key] = buffer
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, used, memo) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, used, memo) for v in obj)
+        return obj
+
+    def save(self, checkpoint, path, step=None):
+        "write checkpoint to path in the background, step names the copy that is kept when keep > 1"
+        self.wait() # the buffers of the previous checkpoint are free once it is on disk
+        used = []
+        snapshot = self._snapshot(checkpoint, used, {})
+        self.buffers = used
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self.thread = threading.Thread(target=self._write, args=(snapshot, Path(path), step, copied))
+        self.thread.start()
+
+    def _write(self, snapshot, path, step, copied):
+        try:
+            start = time.time()
+            if copied is not None:
+                copied.synchronize()
+            tmp = path.with_name(path.name + '.tmp')
+            torch.save(snapshot, tmp)
+            os.replace(tmp, path)
+            if self.keep > 1 and step is not None:
+                self._rotate(path, step)
+            print(f"wrote {path} in {time.time() - start:.1f}s")
+        except Exception as e:
+            self.error = e
+
+    def _rotate(self, path, step):
+        kept = path.with_name(f'{path.stem}.step{step:07d}{path.suffix}')
+        if kept.exists():
+            kept.unlink()
+        try:
+            os.link(path, kept)
+        except OSError:
+            shutil.copyfile(path, kept) # no hard links on this file system
+        steps = sorted(glob.glob(glob.escape(str(path.with_name(path.stem))) + '.step*' + path.suffix))
+        for old in steps[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        "block until the checkpoint being written is on disk, raise the error if writing it failed"
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,136 @@
+"""
+Fast checkpoint loading.
+
+Checkpoints are opened with torch.load(mmap=True): tensors stay in the page cache and are only read
+when touched, so the optimizer state of training checkpoints is never paged in.
+Models are built on the meta device and take the loaded tensors as their parameters,
+skipping the random initialization they would immediately overwrite.
+
+Convert a training checkpoint to a weights-only one, without the optimizer state:
+
+$ python -m checkpoints exp/uk4b_large/ckpt.pt exp/uk4b_large/weights.pt
+
+LoRA finetuning checkpoints hold only the adapter weights and a reference to the base checkpoint
+they were trained from (its path, size, modification time and content hash), load() puts the two back together.
+Only size and modification time of the base are checked on load, --verify compares the content hash as well:
+
+$ python -m checkpoints --verify exp/pos/ckpt.pt
+"""
+import argparse
+import hashlib
+import itertools
+import os
+from pathlib import Path
+import pickle
+import sys
+
+import torch
+
+from model import GPT, CausalSelfAttention
+import inference
+
+
+def file_hash(path, block_size=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+def base_reference(path):
+    "what adapter checkpoints store about the checkpoint their base weights come from"
+    path = Path(path).resolve()
+    stat = path.stat()
+    return {'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': file_hash(path)}
+
+
+def adapter_state_dict(model):
+    "the trainable parameters of model, the LoRA weights of a model prepared by mark_only_lora_as_trainable"
+    return {name: p for name, p in model.named_parameters() if p.requires_grad}
+
+
+def load_file(path):
+    """
+    memory-map a checkpoint onto the CPU, checkpoints in the legacy torch.save format are read eagerly.
+    Checkpoints are our own files and hold more than tensors (config, int8 packed params), they are fully unpickled.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except (RuntimeError, pickle.UnpicklingError):
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def compose(checkpoint, verify=False):
+    "the weights of the base checkpoint of an adapter checkpoint updated with its adapters"
+    base = checkpoint['base']
+    if not os.path.exists(base['path']):
+        raise FileNotFoundError(f"base checkpoint {base['path']} of the adapters is missing")
+    stat = os.stat(base['path'])
+    if verify:
+        if file_hash(base['path']) != base['sha1']:
+            print(f"WARNING: {base['path']} has changed since the adapters were trained on it", file=sys.stderr)
+    elif (stat.st_size, stat.st_mtime_ns) != (base.get('size'), base.get('mtime_ns')):
+        print(f"WARNING: {base['path']} may have changed since the adapters were trained on it, "
+              f"check its content with python -m checkpoints --verify <adapter checkpoint>", file=sys.stderr)
+    state_dict = inference.strip_compile_prefix(load_file(base['path'])['model'])
+    # runs with a smaller block_size than the base crop it, as GPT.crop_block_size does
+    block_size = checkpoint['model_args']['block_size']
+    for k, v in state_dict.items():
+        if k == 'transformer.wpe.weight':
+            state_dict[k] = v[:block_size]
+        elif k.endswith('.attn.bias') and v.dim() == 4: # causal mask buffer
+            state_dict[k] = v[:, :, :block_size, :block_size]
+    state_dict.update(inference.strip_compile_prefix(checkpoint['model']))
+    return {**checkpoint, 'model': state_dict}
+
+
+def load(path, verify=False):
+    "load_file, with the base weights of adapter checkpoints filled in"
+    checkpoint = load_file(path)
+    if 'base' in checkpoint:
+        checkpoint = compose(checkpoint, verify=verify)
+    return checkpoint
+
+
+def build_model(gptconf, state_dict, strict=True, prepare=None):
+    """
+    GPT(gptconf) with the tensors of state_dict as parameters: no random init and no copies.
+    Parameters missing from state_dict are an error even when strict is False,
+    only the causal mask buffer is recreated. prepare(model) may swap modules of the meta model before loading.
+    """
+    with torch.device('meta'):
+        model = GPT(gptconf)
+    if prepare is not None:
+        prepare(model)
+    model.load_state_dict(inference.strip_compile_prefix(state_dict), strict=strict, assign=True)
+    if isinstance(model.lm_head, torch.nn.Linear):
+        # assign replaces the tied parameters separately, tie them again
+        model.transformer.wte.weight = model.lm_head.weight
+
+    for module in model.modules():
+        if isinstance(module, CausalSelfAttention) and not module.flash and module.bias.is_meta:
+            block_size = gptconf.block_size
+            module.bias = torch.tril(torch.ones(block_size, block_size)).view(1, 1, block_size, block_size)
+    missing = [name for name, t in itertools.chain(model.named_parameters(), model.named_buffers()) if t.is_meta]
+    if missing:
+        raise ValueError(f'checkpoint has no values for {missing}')
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('checkpoints')
+    parser.add_argument('--verify', action='store_true', help='compare the content hash of the base of adapter checkpoints')
+    parser.add_argument('ckpt_path', type=Path)
+    parser.add_argument('out_path', type=Path, nargs='?', help='weights-only checkpoint to write, nothing is written without it')
+    args = parser.parse_args()
+
+    checkpoint = load(args.ckpt_path, verify=args.verify)
+    if args.out_path is None:
+        sys.exit(0)
+    # everything the inference scripts read, nothing of the training state
+    keep = ['model', 'model_args', 'quantized', 'merged_lora']
+    weights = {key: checkpoint[key] for key in keep if key in checkpoint}
+    weights['model'] = inference.strip_compile_prefix(weights['model'])
+    torch.save(weights, args.out_path)
+    print(f'wrote {args.out_path}, dropped {sorted(set(checkpoint) - set(keep))}', file=sys.stderr)
@@ -0,0 +1,56 @@
+"""
+Document index next to the token .bin files written by prepare.py and prepare1.py.
+
+train.bin.idx holds the int64 offsets of every document start followed by the total number of tokens,
+so document i is tokens[offsets[i]:offsets[i+1]] including its endoftext separator.
+The .bin itself stays one flat uint16 stream, training on it does not need the index.
+
+    docs = Documents('exp/pos/train.bin')
+    docs[0] # tokens of the first document
+    for doc in docs.shuffled(seed=1337): ...
+"""
+import numpy as np
+
+
+def index_path(bin_path):
+    return str(bin_path) + '.idx'
+
+
+def write_index(bin_path, lengths):
+    "write the offsets of documents of the given token lengths, in the order they are in bin_path"
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    offsets.tofile(index_path(bin_path))
+    return offsets
+
+
+class Documents:
+    "O(1) random access to the documents of a .bin file through its index, nothing is read until used"
+
+    def __init__(self, bin_path):
+        self.tokens = np.memmap(bin_path, dtype=np.uint16, mode='r')
+        self.offsets = np.memmap(index_path(bin_path), dtype=np.int64, mode='r')
+        if self.offsets[-1] != len(self.tokens):
+            raise ValueError(f'{index_path(bin_path)} indexes {self.offsets[-1]} tokens, {bin_path} has {len(self.tokens)}')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def starts(self, block_size):
+        "document starts with room for a window of block_size + 1 tokens after them, for document-aligned sampling"
+        starts = np.asarray(self.offsets[:-1])
+        return starts[starts + block_size + 1 <= len(self.tokens)]
+
+    def sample(self, batch_size, block_size, rng):
+        "windows of block_size + 1 tokens starting at random documents, shape (batch_size, block_size + 1)"
+        starts = self.starts(block_size)
+        ix = starts[rng.integers(len(starts), size=batch_size)]
+        return self.tokens[ix[:, None] + np.arange(block_size + 1)]
+
+    def shuffled(self, seed=1337):
+        "iterate over the documents in a random order without rewriting the token file"
+        for i in np.random.default_rng(seed).permutation(len(self)):
+            yield self[i]
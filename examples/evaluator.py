@@ -0,0 +1,125 @@
+"""
+Evaluate the checkpoints of a finetuning run while it trains, on devices the training does not use.
+
+Watches a checkpoint directory for the checkpoints train.py keeps as <stem>.step<iter>.pt (see keep_checkpoints)
+and runs a decode and a metric command for every new one, one checkpoint at a time on each of --devices.
+The commands are shell templates of {ckpt}, {device} and {out}, an output prefix for the checkpoint under --work_dir.
+Whatever the metric command prints goes to the metrics log as a json line with the checkpoint and its step.
+Checkpoints are hard linked into the work dir as soon as they appear, rotation can't remove them before they are evaluated,
+and checkpoints already in the log are skipped, so the evaluator can be restarted at any time.
+
+$ python -m evaluator --devices cuda:1 \
+    --decode 'python -m score --seq_len 512 --unblank --lora --device {device} {ckpt} --paragraphs data/udpos/test.inline.gpt2.txt.blank > {out}.txt' \
+    --metric 'make {out}.ark >&2 && compute-wer --mode=strict ark:data/udpos/test.gpt2.ark ark:{out}.ark' \
+    exp/pos
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import queue
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+parser = argparse.ArgumentParser('evaluator')
+parser.add_argument('--devices', type=str, nargs='+', default=['cpu'], help='one evaluation at a time runs on each, repeat cpu for a pool')
+parser.add_argument('--decode', type=str, required=True, help='shell command writing the decoded outputs of {ckpt} to {out}.*')
+parser.add_argument('--metric', type=str, required=True, help='shell command printing the metrics of {out}.*')
+parser.add_argument('--pattern', type=str, default='*.step*.pt', help='checkpoints to evaluate in ckpt_dir')
+parser.add_argument('--work_dir', type=Path, help='decoded outputs, ckpt_dir/eval by default')
+parser.add_argument('--log', type=Path, help='metrics log, ckpt_dir/metrics.jsonl by default')
+parser.add_argument('--interval', type=float, default=30, help='seconds between looks at ckpt_dir')
+parser.add_argument('--once', action='store_true', help='evaluate the checkpoints that are there and exit')
+parser.add_argument('ckpt_dir', type=Path)
+
+
+def step_of(path):
+    match = re.search(r'\.step(\d+)\.', path.name)
+    return int(match.group(1)) if match else None
+
+
+def order(path):
+    return step_of(path) or 0, path.name
+
+
+def evaluated(log_path):
+    "names of the checkpoints in the metrics log"
+    if not log_path.exists():
+        return set()
+    with open(log_path) as f:
+        return {json.loads(line)['ckpt'] for line in f if line.strip()}
+
+
+def hold(path, work_dir):
+    "a hard link to path in work_dir that outlives the rotation of path, or path itself when links are not possible"
+    link = work_dir / path.name
+    if link.exists():
+        return link
+    try:
+        os.link(path, link)
+        return link
+    except FileNotFoundError:
+        return None # rotated away already
+    except OSError:
+        return path
+
+
+def evaluate(ckpt, device, args):
+    "run the decode and metric commands for ckpt on device, the record for the metrics log"
+    fields = {'ckpt': shlex.quote(str(ckpt)), 'device': shlex.quote(device), 'out': shlex.quote(str(args.work_dir / ckpt.stem))}
+    record = {'ckpt': ckpt.name, 'step': step_of(ckpt), 'device': device}
+    start = time.time()
+    decode = subprocess.run(args.decode.format(**fields), shell=True)
+    if decode.returncode != 0:
+        return record | {'error': f'decode exited with {decode.returncode}', 'seconds': time.time() - start}
+    metric = subprocess.run(args.metric.format(**fields), shell=True, stdout=subprocess.PIPE, text=True)
+    if metric.returncode != 0:
+        return record | {'error': f'metric exited with {metric.returncode}', 'seconds': time.time() - start}
+    return record | {'metric': metric.stdout.strip(), 'seconds': time.time() - start}
+
+
+def worker(device, todo, args, log_lock):
+    while True:
+        ckpt = todo.get()
+        try:
+            record = evaluate(ckpt, device, args)
+            with log_lock, open(args.log, 'a') as f:
+                print(json.dumps(record, ensure_ascii=False), file=f, flush=True)
+            print(f"{record['ckpt']} on {device}: {record.get('metric', record.get('error'))}", file=sys.stderr)
+            if ckpt.parent == args.work_dir:
+                ckpt.unlink() # the held link, the outputs stay
+        finally:
+            todo.task_done()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.work_dir = args.work_dir or args.ckpt_dir / 'eval'
+    args.log = args.log or args.ckpt_dir / 'metrics.jsonl'
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+
+    todo, log_lock = queue.Queue(), threading.Lock()
+    for device in args.devices:
+        threading.Thread(target=worker, args=(device, todo, args, log_lock), daemon=True).start()
+
+    seen = evaluated(args.log)
+    while True:
+        # held links left by an interrupted evaluator first, then the new checkpoints in the order of their steps
+        found = sorted(args.work_dir.glob(args.pattern), key=order) + sorted(args.ckpt_dir.glob(args.pattern), key=order)
+        for path in found:
+            if path.name in seen:
+                continue
+            ckpt = hold(path, args.work_dir)
+            if ckpt is None:
+                print(f'WARNING: {path} was removed before it could be evaluated', file=sys.stderr)
+                continue
+            seen.add(path.name)
+            todo.put(ckpt)
+        if args.once:
+            todo.join()
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,81 @@
+"""
+Device handling shared by the inference scripts (score.py, sample.py, ner.py, beam.py):
+autocast on CUDA or CPU, the intra-op thread pool and a tokens/s report for sizing.
+"""
+from collections import OrderedDict
+from contextlib import nullcontext
+import sys
+import time
+
+import torch
+
+
+def add_arguments(parser):
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads for CPU inference, 0 keeps the torch default')
+    parser.add_argument('--no_compile', action='store_true', help='do not torch.compile the model (never compiled on CPU)')
+
+
+def device_type(device):
+    return 'cuda' if 'cuda' in device else 'cpu'
+
+
+def setup(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if device_type(args.device) == 'cuda':
+        torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+        torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+
+
+def should_compile(args):
+    return not args.no_compile and device_type(args.device) == 'cuda'
+
+
+def autocast(device, dtype=torch.bfloat16):
+    """
+    Mixed precision context for the device. CPUs autocast to bfloat16 only,
+    float32 disables autocast altogether.
+    """
+    if dtype == torch.float32:
+        return nullcontext()
+    if device_type(device) == 'cpu':
+        return torch.amp.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return torch.amp.autocast(device_type='cuda', dtype=dtype)
+
+
+def strip_compile_prefix(state_dict):
+    """
+    checkpoints of compiled models prefix their keys with _orig_mod.
+    The module versions in state_dict._metadata are kept under the stripped names,
+    quantized modules need them to read their weights.
+    """
+    unwanted_prefix = '_orig_mod'
+    def strip(k):
+        return k[len(unwanted_prefix)+1:] if k.startswith(unwanted_prefix + '.') else '' if k == unwanted_prefix else k
+    stripped = OrderedDict((strip(k), v) for k, v in state_dict.items())
+    metadata = getattr(state_dict, '_metadata', None)
+    if metadata is not None:
+        stripped._metadata = OrderedDict((strip(k), v) for k, v in metadata.items())
+    return stripped
+
+
+class Throughput:
+    "Counts tokens (and optionally sentences) forwarded through the model and reports them per second on stderr."
+
+    def __init__(self, device):
+        self.device = device
+        self.tokens = 0
+        self.sentences = 0
+        self.start = time.time()
+
+    def add(self, tokens, sentences=0):
+        self.tokens += tokens
+        self.sentences += sentences
+
+    def report(self):
+        if device_type(self.device) == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elapsed = time.time() - self.start
+        sentences = f', {self.sentences} sentences, {self.sentences / elapsed:.1f} sentences/s' if self.sentences else ''
+        print(f'{self.tokens} tokens in {elapsed:.2f}s, {self.tokens / elapsed:.1f} tokens/s{sentences} '
+              f'on {self.device} with {torch.get_num_threads()} threads', file=sys.stderr)
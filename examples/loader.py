@@ -0,0 +1,85 @@
+"""
+Prefetching data loader for the uint16 token memmaps written by prepare.py.
+
+A batch is batch_size random windows of block_size + 1 tokens gathered with one vectorized index
+into the memmap, x and y are the two overlapping views of it. A background thread fills
+reusable (pinned, when training on CUDA) buffers prefetch batches ahead of the training loop,
+and the loader keeps track of how long the training loop had to wait for them.
+With starts, e.g. the document starts of a .bin.idx index, windows only begin at these offsets.
+state_dict() is the position in the stream of batches after the last one handed out,
+a loader created with it as state continues with exactly the batches that would have followed.
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class BatchLoader:
+
+    def __init__(self, data, batch_size, block_size, device, prefetch=2, starts=None, state=None):
+        self.data = data
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.device = device
+        self.starts = starts
+        self.cuda = 'cuda' in device
+        # own generator for the background thread, seeded from the global one so that runs stay reproducible
+        self.generator = torch.Generator().manual_seed(int(torch.randint(2**62, ())))
+        if state is not None:
+            self.generator.set_state(state['generator'])
+        self.position = self.generator.get_state() # the thread runs ahead, this is where next() stands
+        self.offsets = np.arange(block_size + 1)
+        self.wait = 0.
+
+        # buffers cycle between free (with the event of their last copy to the GPU) and ready
+        self.free = queue.Queue()
+        self.ready = queue.Queue(maxsize=prefetch)
+        for _ in range(prefetch + 2):
+            buffer = torch.empty((batch_size, block_size + 1), dtype=torch.int64, pin_memory=self.cuda)
+            self.free.put((buffer, None))
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                buffer, copied = self.free.get()
+                if copied is not None:
+                    copied.synchronize() # the previous batch in this buffer has reached the GPU
+                if self.starts is None:
+                    ix = torch.randint(len(self.data) - self.block_size, (self.batch_size,), generator=self.generator).numpy()
+                else:
+                    ix = self.starts[torch.randint(len(self.starts), (self.batch_size,), generator=self.generator).numpy()]
+                np.copyto(buffer.numpy(), self.data[ix[:, None] + self.offsets])
+                self.ready.put((buffer, self.generator.get_state()))
+        except Exception as e:
+            self.ready.put(e)
+
+    def next(self):
+        start = time.time()
+        item = self.ready.get()
+        self.wait += time.time() - start
+        if isinstance(item, Exception):
+            raise item
+        buffer, self.position = item
+
+        # one copy of the whole window, x and y are made contiguous on the device.
+        # On the CPU .to() would return the buffer itself, which goes back to the fill thread right away
+        xy = buffer.to(self.device, non_blocking=self.cuda, copy=not self.cuda)
+        x, y = xy[:, :-1].contiguous(), xy[:, 1:].contiguous()
+        copied = None
+        if self.cuda:
+            copied = torch.cuda.Event()
+            copied.record()
+        self.free.put((buffer, copied))
+        return x, y
+
+    def state_dict(self):
+        return {'generator': self.position}
+
+    def pop_wait(self):
+        "seconds spent waiting for batches since the previous call"
+        wait, self.wait = self.wait, 0.
+        return wait
@@ -0,0 +1,85 @@
+"""
+Batched logits processors for beam search, sampling and constrained decoding.
+
+Every processor works on scores of shape (N, vocab) for N hypotheses and the tokens generated so far,
+a LongTensor history of shape (N, cur_len), using tensor ops only: no .tolist() and no per-row python loops,
+so they never synchronize with the GPU and their cost barely depends on N.
+"""
+import torch
+
+
+def enforce_repetition_penalty_(scores, history, repetition_penalty):
+    """repetition penalty (from CTRL paper https://arxiv.org/abs/1909.05858). """
+    score = scores.gather(1, history)
+    # if score < 0 then repetition penalty has to multiplied to reduce the previous token probability
+    score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+    # repeated tokens gather the same score and scatter back the same value, so each is penalized once
+    scores.scatter_(1, history, score)
+    return scores
+
+
+def banned_ngram_mask(history, no_repeat_ngram_size, vocab_size):
+    """
+    Mark the tokens that would repeat an ngram of no_repeat_ngram_size tokens already present in history,
+    as in fairseq's no_repeat_ngram in beam_search. Returns a bool mask of shape (N, vocab_size).
+    """
+    n = no_repeat_ngram_size
+    num_hypos, cur_len = history.shape
+    # one extra column collects the tokens of ngrams that do not match
+    mask = torch.zeros((num_hypos, vocab_size + 1), dtype=torch.bool, device=history.device)
+    if cur_len < n:
+        # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
+        return mask[:, :vocab_size]
+
+    ngrams = history.unfold(1, n, 1) # (N, cur_len - n + 1, n)
+    # before decoding the next token, prevent decoding of ngrams that start with the last n - 1 tokens
+    last = history[:, cur_len - n + 1:].unsqueeze(1) # (N, 1, n - 1)
+    hits = (ngrams[:, :, :-1] == last).all(dim=-1) # (N, cur_len - n + 1)
+    banned = torch.where(hits, ngrams[:, :, -1], vocab_size)
+    mask.scatter_(1, banned, True)
+    return mask[:, :vocab_size]
+
+
+def ban_repeated_ngrams_(scores, history, no_repeat_ngram_size):
+    return scores.masked_fill_(banned_ngram_mask(history, no_repeat_ngram_size, scores.size(-1)), -float("inf"))
+
+
+def enforce_min_length_(scores, cur_len, min_length, eos_token_id):
+    # set eos token prob to zero if min_length is not reached
+    if cur_len < min_length:
+        scores[:, eos_token_id] = -float("inf")
+    return scores
+
+
+class LogitsProcessor:
+    """
+    Applies repetition penalty, EOS masking until min_length and no-repeat-ngram blocking in this order.
+    Call it with scores (N, vocab) and history (N, cur_len) or None before anything is generated,
+    scores are modified in place and returned.
+    """
+
+    def __init__(
+        self,
+        repetition_penalty=1.0,
+        no_repeat_ngram_size=0,
+        min_length=0,
+        eos_token_id=None,
+    ):
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.min_length = min_length
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, scores, history=None):
+        cur_len = 0 if history is None else history.size(1)
+
+        if self.repetition_penalty != 1.0 and cur_len > 0:
+            enforce_repetition_penalty_(scores, history, self.repetition_penalty)
+
+        if self.eos_token_id is not None:
+            enforce_min_length_(scores, cur_len, self.min_length, self.eos_token_id)
+
+        if self.no_repeat_ngram_size > 0 and cur_len > 0:
+            ban_repeated_ngrams_(scores, history, self.no_repeat_ngram_size)
+
+        return scores
@@ -4,9 +4,13 @@ import warnings
 import torch
 import torch.nn as nn
 from peft import LoraConfig, TaskType
-from peft.tuners.lora import Linear, Linear8bitLt, MergedLinear, LoraLayer
+from peft.tuners.lora import Linear, MergedLinear, LoraLayer
 from transformers.pytorch_utils import Conv1D
-import bitsandbytes as bnb
+try:
+    import bitsandbytes as bnb
+    from peft.tuners.lora import Linear8bitLt
+except ImportError: # bitsandbytes needs CUDA, there are no 8-bit layers to replace on CPU-only hosts
+    bnb = None
 
 gpt2_peft_config = LoraConfig(
     task_type=TaskType.CAUSAL_LM, inference_mode=False, r=4, lora_alpha=32, lora_dropout=0.1,
@@ -29,7 +33,7 @@ def lora_find_and_replace(self, peft_config):
                 is_target_modules_in_base_model = True
             parent, target, target_name = _get_submodules(self, key)
             bias = target.bias is not None
-            if isinstance(target, bnb.nn.Linear8bitLt) and peft_config.enable_lora is None:
+            if bnb is not None and isinstance(target, bnb.nn.Linear8bitLt) and peft_config.enable_lora is None:
                 kwargs.update(
                     {
                         "has_fp16_weights": target.state.has_fp16_weights,
@@ -0,0 +1,102 @@
+"""
+Fold LoRA adapters into the base weights and write a plain GPT checkpoint.
+
+The merged checkpoint loads without peft or the LoRA classes, so c_attn is a single matmul again
+and the model can be compiled. Logits of the merged model are checked against the unmerged one.
+
+$ python -m merge_lora exp/pos/ckpt.pt exp/pos/merged.pt
+$ python -m beam exp/pos/merged.pt ...
+"""
+import argparse
+import dataclasses
+from pathlib import Path
+import sys
+
+import torch
+
+from model import GPTConfig, GPT
+import inference
+import checkpoints
+
+
+def has_lora(state_dict):
+    return any('lora_' in k for k in state_dict)
+
+
+def strip_peft_prefix(state_dict):
+    """get_peft_model checkpoints prefix the keys of lora_find_and_replace with base_model.model."""
+    peft_prefix = 'base_model.model.'
+    state_dict = inference.strip_compile_prefix(state_dict)
+    return {k[len(peft_prefix):] if k.startswith(peft_prefix) else k: v for k, v in state_dict.items()}
+
+
+def merge_lora(state_dict, lora_alpha=32):
+    """
+    Returns a copy of state_dict with W += B @ A * lora_alpha / r for every adapted module
+    and the adapter tensors removed.
+    """
+    state_dict = strip_peft_prefix(state_dict)
+    merged = {k: v for k, v in state_dict.items() if not 'lora_' in k}
+    for k, A in state_dict.items():
+        if not k.endswith('.lora_A.weight'):
+            continue
+        module = k[:-len('.lora_A.weight')]
+        B = state_dict[module + '.lora_B.weight']
+        W = merged[module + '.weight']
+        r = A.size(0)
+        # accumulate in float32, the delta is small compared to the weight
+        merged[module + '.weight'] = (W.float() + (B.float() @ A.float()) * (lora_alpha / r)).to(W.dtype)
+    return merged
+
+
+@torch.no_grad()
+def max_logits_diff(model, merged_model, vocab_size, block_size, batch_size, device):
+    x = torch.randint(vocab_size, (batch_size, block_size), device=device)
+    y, _ = model(x, decode_full=True)
+    y_merged, _ = merged_model(x, decode_full=True)
+    return (y.float() - y_merged.float()).abs().max().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('merge_lora')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--lora_alpha', type=int, default=32, help='lora_alpha the adapters were trained with, see gpt2_peft_config')
+    parser.add_argument('--check_batch_size', type=int, default=2, help='random sequences of block_size tokens to compare logits on')
+    parser.add_argument('--atol', type=float, default=1e-2, help='max absolute logits difference allowed in float32')
+    parser.add_argument('ckpt_path', type=Path)
+    parser.add_argument('out_path', type=Path)
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+
+    checkpoint = checkpoints.load(args.ckpt_path)
+    if not has_lora(checkpoint['model']):
+        parser.error(f'{args.ckpt_path} has no LoRA adapters to merge')
+    gptconf = GPTConfig(**checkpoint['model_args'])
+
+    state_dict = merge_lora(checkpoint['model'], lora_alpha=args.lora_alpha)
+
+    merged_model = checkpoints.build_model(gptconf, state_dict)
+    merged_model.eval()
+    merged_model.to(args.device)
+
+    # the unmerged reference needs the LoRA classes
+    from lora import gpt2_peft_config, lora_find_and_replace
+    model = GPT(gptconf)
+    lora_find_and_replace(model, dataclasses.replace(gpt2_peft_config, lora_alpha=args.lora_alpha))
+    model.load_state_dict(strip_peft_prefix(checkpoint['model']))
+    model.eval()
+    model.to(args.device)
+
+    diff = max_logits_diff(model, merged_model, gptconf.vocab_size, gptconf.block_size, args.check_batch_size, args.device)
+    print(f'max abs logits difference {diff:.2e}', file=sys.stderr)
+    if diff > args.atol:
+        print(f'merged model differs from the adapted model by more than {args.atol}, not writing {args.out_path}', file=sys.stderr)
+        sys.exit(1)
+
+    torch.save({
+        'model': state_dict,
+        'model_args': checkpoint['model_args'],
+        'merged_lora': {'ckpt_path': str(args.ckpt_path), 'lora_alpha': args.lora_alpha},
+    }, args.out_path)
+    print(f'wrote {args.out_path}', file=sys.stderr)
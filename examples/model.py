@@ -7,6 +7,7 @@ https://github.com/openai/gpt-2/blob/master/src/model.py
 https://github.com/huggingface/transformers/blob/main/src/transformers/models/gpt2/modeling_gpt2.py
 """
 
+from contextlib import nullcontext
 import math
 import inspect
 from dataclasses import dataclass, asdict
@@ -14,7 +15,11 @@ from dataclasses import dataclass, asdict
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-import bitsandbytes as bnb
+from torch.utils.checkpoint import checkpoint
+try:
+    import bitsandbytes as bnb
+except ImportError: # bitsandbytes needs CUDA, use the equivalent StableEmbedding below on CPU-only hosts
+    bnb = None
 
 # @torch.jit.script # good to enable when not using torch.compile, disable when using (our default)
 def new_gelu(x):
@@ -24,6 +29,51 @@ def new_gelu(x):
     """
     return 0.5 * x * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * torch.pow(x, 3.0))))
 
+def chunk_cross_entropy(head, x, labels, ignore_index=-1, label_smoothing=0.0, blank=None, autocast_loss=True):
+    """
+    Project hidden states x of shape (b, t, n_embd) with head and return the per-token cross entropy
+    against labels (b, t) together with argmax predictions (b, t). Labels equal to blank are replaced
+    with the predictions before computing their loss. Autocast computes the loss in float32,
+    without autocast_loss it is computed in the dtype of the logits, like outside the autocast region.
+    """
+    logits = head(x)
+    predictions = logits.argmax(-1)
+    if blank is not None:
+        labels = torch.where(labels == blank, predictions, labels)
+    with nullcontext() if autocast_loss else torch.autocast(device_type=logits.device.type, enabled=False):
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), labels.reshape(-1), ignore_index=ignore_index,
+                               reduction='none', label_smoothing=label_smoothing)
+    return loss.view_as(labels), predictions
+
+def chunked_cross_entropy(head, x, labels, chunk_size, ignore_index=-1, label_smoothing=0.0, blank=None, autocast_loss=True):
+    """
+    Same as chunk_cross_entropy but projects only chunk_size time steps at a time, so the full (b, t, vocab)
+    logits are never materialized. When gradients are needed, each chunk recomputes its logits in backward.
+    """
+    losses, predictions = [], []
+    for t in range(0, x.size(1), chunk_size):
+        inputs = (head, x[:, t:t+chunk_size], labels[:, t:t+chunk_size], ignore_index, label_smoothing, blank, autocast_loss)
+        if torch.is_grad_enabled():
+            loss, prediction = checkpoint(chunk_cross_entropy, *inputs, use_reentrant=False)
+        else:
+            loss, prediction = chunk_cross_entropy(*inputs)
+        losses.append(loss)
+        predictions.append(prediction)
+    return torch.cat(losses, dim=1), torch.cat(predictions, dim=1)
+
+class StableEmbedding(nn.Embedding):
+    """ Embedding followed by a full precision LayerNorm, same forward and parameters as bitsandbytes.nn.StableEmbedding """
+
+    def __init__(self, num_embeddings, embedding_dim):
+        super().__init__(num_embeddings, embedding_dim)
+        self.norm = nn.LayerNorm(embedding_dim)
+
+    def forward(self, input):
+        emb = super().forward(input)
+        # always apply layer norm in full precision
+        emb = emb.to(torch.get_default_dtype())
+        return self.norm(emb).to(self.weight.dtype)
+
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
 
@@ -58,7 +108,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, layer_past=None, use_cache=False, attn_mask=None, prefix=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -67,22 +117,63 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        if self.flash:
+        # layer_past holds keys and values of the previous positions stacked as (2, B, nh, P, hs)
+        present = None
+        if layer_past is not None:
+            present = torch.cat((layer_past, torch.stack((k, v))), dim=-2)
+            k, v = present[0], present[1]
+        elif use_cache:
+            present = torch.stack((k, v))
+        S = k.size(-2) # number of keys, P + T
+        P = S - T # number of cached positions preceding the queries
+
+        if attn_mask is None and (prefix is not None or (P > 0 and T > 1)):
+            # is_causal aligns the mask to the top left corner, we need it aligned to the bottom right
+            attn_mask = torch.ones(T, S, dtype=torch.bool, device=x.device).tril(diagonal=P)
+
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, S) -> (B, nh, T, S)
+        if prefix is not None:
+            y = self.prefix_attention(q, k, v, prefix, attn_mask)
+        elif self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout, is_causal=True)
+            # a single new query without a mask may attend to every cached position
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout,
+                                                                 is_causal=attn_mask is None and P == 0)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            if attn_mask is None:
+                att = att.masked_fill(self.bias[:,:,P:S,:S] == 0, float('-inf'))
+            else:
+                att = att.masked_fill(~attn_mask, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
-            y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+            y = att @ v # (B, nh, T, S) x (B, nh, S, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
         y = self.resid_dropout(self.c_proj(y))
-        return y
+        return y, present
+
+    def prefix_attention(self, q, k, v, prefix, attn_mask):
+        """
+        Attend over the keys and values of a prefix shared by all rows, stacked as (2, 1, nh, Cp, hs),
+        followed by the keys and values of each row. The prefix is multiplied with all rows at once
+        as a batch over heads, so it is never expanded to the batch size.
+        """
+        B, nh, T, hs = q.size()
+        Cp = prefix.size(-2)
+        scale = 1.0 / math.sqrt(hs)
+
+        qh = q.transpose(0, 1).reshape(nh, B * T, hs)
+        att_prefix = (qh @ prefix[0, 0].transpose(-2, -1)).view(nh, B, T, Cp).transpose(0, 1) # (B, nh, T, Cp)
+        att = (q @ k.transpose(-2, -1)).masked_fill(~attn_mask, float('-inf')) # (B, nh, T, S)
+        att = F.softmax(torch.cat((att_prefix, att), dim=-1) * scale, dim=-1)
+        att = self.attn_dropout(att)
+        att_prefix, att = att[..., :Cp], att[..., Cp:]
+
+        y = (att_prefix.transpose(0, 1).reshape(nh, B * T, Cp) @ prefix[1, 0]).view(nh, B, T, hs).transpose(0, 1)
+        return y + att @ v # (B, nh, T, hs)
 
 class MLP(nn.Module):
 
@@ -108,10 +199,11 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, layer_past=None, use_cache=False, attn_mask=None, prefix=None):
+        y, present = self.attn(self.ln_1(x), layer_past=layer_past, use_cache=use_cache, attn_mask=attn_mask, prefix=prefix)
+        x = x + y
         x = x + self.mlp(self.ln_2(x))
-        return x
+        return x, present
 
 @dataclass
 class GPTConfig:
@@ -135,10 +227,11 @@ class GPT(nn.Module):
         self.config = config
 
         if self.config.vocab_size == 50257: # large
+            stable_embedding = StableEmbedding if bnb is None else bnb.nn.StableEmbedding
             self.transformer = nn.ModuleDict(dict(
                 # XXX: these embeddings used by uk4b_large
-                wte = bnb.nn.StableEmbedding(config.vocab_size, config.n_embd),
-                wpe = bnb.nn.StableEmbedding(config.block_size, config.n_embd),
+                wte = stable_embedding(config.vocab_size, config.n_embd),
+                wpe = stable_embedding(config.block_size, config.n_embd),
 
                 drop = nn.Dropout(config.dropout),
                 h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
@@ -200,21 +293,33 @@ class GPT(nn.Module):
                 output_attentions=None, output_hidden_states=None,
                 return_dict=None,
                 decode_full=False,
+                past=None,
+                use_cache=False,
+                prefix=None,
+                loss_chunk_size=None,
                 ):
-        device = input_ids.device
-        b, t = input_ids.size()
-        #assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+        """
+        With labels and loss_chunk_size the loss is computed loss_chunk_size positions at a time
+        without materializing the logits, which are returned as None.
 
-        # forward the GPT model itself
-        tok_emb = self.transformer.wte(input_ids) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
-        x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
-        x = self.transformer.ln_f(x)
+        past is a tuple of per-layer key/value caches of shape (2, b, n_head, past_length, head_size)
+        as returned by a previous call with use_cache=True. input_ids then continue the cached
+        sequence at position past_length. With use_cache=True the updated caches are returned
+        as the third element: (logits, loss, presents).
+
+        prefix is a cache of the same layout computed for a single sequence (batch size 1).
+        It is shared by all b rows without being copied, and the rows continue it.
+
+        attention_mask of shape (b, past_length + t) marks real tokens with 1 and padding with 0.
+        Padded positions are never attended to and do not advance the positions of real tokens.
+        """
+        x, presents = self.hidden_states(input_ids, attention_mask=attention_mask, past=past, use_cache=use_cache, prefix=prefix)
 
-        if labels is not None:
+        if labels is not None and loss_chunk_size:
+            logits = None
+            losses, _ = chunked_cross_entropy(self.lm_head, x, labels, loss_chunk_size, ignore_index=-1, label_smoothing=0.1)
+            loss = losses.sum() / (labels != -1).sum()
+        elif labels is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1), ignore_index=-1,
@@ -228,8 +333,56 @@ class GPT(nn.Module):
             logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
             loss = None
 
+        if use_cache:
+            return logits, loss, presents
         return logits, loss
 
+    def hidden_states(self, input_ids, attention_mask=None, past=None, use_cache=False, prefix=None):
+        """
+        Forward the transformer up to the final layer norm, see forward for the arguments.
+        Returns hidden states of shape (b, t, n_embd) and the per-layer caches (None unless use_cache).
+        """
+        device = input_ids.device
+        b, t = input_ids.size()
+        past_length = 0 if past is None else past[0].size(-2)
+        prefix_length = 0 if prefix is None else prefix[0].size(-2)
+        #assert prefix_length + past_length + t <= self.config.block_size, f"Cannot forward sequence of length {prefix_length + past_length + t}, block size is only {self.config.block_size}"
+        if attention_mask is None:
+            start = prefix_length + past_length
+            pos = torch.arange(start, start + t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+            attn_mask = None
+        else:
+            attention_mask = attention_mask.bool()
+            pos = prefix_length + (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, -t:] # shape (b, t)
+            causal = torch.ones(t, past_length + t, dtype=torch.bool, device=device).tril(diagonal=past_length)
+            # every position may see itself so that the rows of padding never end up empty
+            diagonal = causal.triu(diagonal=past_length)
+            attn_mask = causal & (attention_mask[:, None, None, :] | diagonal) # shape (b, 1, t, past_length + t)
+
+        # forward the GPT model itself
+        tok_emb = self.transformer.wte(input_ids) # token embeddings of shape (b, t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
+        x = self.transformer.drop(tok_emb + pos_emb)
+        presents = []
+        for i, block in enumerate(self.transformer.h):
+            x, present = block(x, layer_past=None if past is None else past[i], use_cache=use_cache,
+                               attn_mask=attn_mask, prefix=None if prefix is None else prefix[i])
+            presents.append(present)
+        x = self.transformer.ln_f(x)
+
+        return x, tuple(presents) if use_cache else None
+
+    def score(self, input_ids, labels, chunk_size=128, blank=None, attention_mask=None):
+        """
+        Negative log-likelihoods of labels (b, t) and argmax predictions at every position of input_ids (b, t),
+        projecting onto the vocabulary chunk_size positions at a time. Labels equal to blank are replaced
+        with the predictions before their loss is computed. Labels of -1 are ignored and get zero loss.
+        The loss is computed in the dtype of the logits, the same numbers as cross entropy of forward's logits
+        outside autocast, whatever the chunk_size.
+        """
+        x, _ = self.hidden_states(input_ids, attention_mask=attention_mask)
+        return chunked_cross_entropy(self.lm_head, x, labels, chunk_size, ignore_index=-1, blank=blank, autocast_loss=False)
+
     def crop_block_size(self, block_size):
         # model surgery to decrease the block size if necessary
         # e.g. we may load the GPT2 pretrained model checkpoint (block size 1024)
@@ -356,19 +509,36 @@ class GPT(nn.Module):
         return optimizer
 
     @torch.no_grad()
-    def generate(self, idx, steps, temperature=1.0, top_k=None):
+    def generate(self, idx, steps, temperature=1.0, top_k=None, use_cache=True, logits_processor=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache the prompt is encoded once and every step forwards only the newest token.
+        logits_processor is called with the logits of the final step and the tokens generated so far.
         """
+        past = None
+        prompt_length = idx.size(1)
         for _ in range(steps):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
+            if idx.size(1) > self.config.block_size:
+                # if the sequence context is growing too long we must crop it at block_size.
+                # positions shift with the window, so the cache cannot be reused from here on
+                idx_cond, past = idx[:, -self.config.block_size:], None
+                logits, _ = self(idx_cond)
+            elif use_cache:
+                # forward the whole prompt once, then only the token sampled at the previous step
+                idx_cond = idx if past is None else idx[:, -1:]
+                logits, _, past = self(idx_cond, past=past, use_cache=True)
+            else:
+                # forward the model to get the logits for the index in the sequence
+                logits, _ = self(idx)
+            # pluck the logits at the final step
+            logits = logits[:, -1, :]
+            # optionally penalize repetitions, mask eos and so on
+            if logits_processor is not None:
+                logits = logits_processor(logits, idx[:, prompt_length:])
+            # scale by desired temperature
+            logits = logits / temperature
             # optionally crop the logits to only the top k options
             if top_k is not None:
                 v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
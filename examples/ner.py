@@ -1,5 +1,9 @@
 """
 Constrained decoding for NER
+
+The words of every sentence are known, only the tag after each / is decoded.
+Sentences are decoded in batches: the known tokens are teacher-forced against a key/value cache
+and the model is only asked for a token at the tag slots, see tagger.decode_slots.
 """
 import argparse
 from pathlib import Path
@@ -7,6 +11,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from model import GPTConfig, GPT
+import inference
+import checkpoints
 import sentencepiece as spm
 import sys
 from termcolor import colored
@@ -15,6 +21,7 @@ from typing import List
 import re
 
 from convert2vulyk import reconstruct_tokenized
+from tagger import decode_slots
 
 
 parser = argparse.ArgumentParser('sample')
@@ -25,16 +32,17 @@ parser.add_argument('--lora', action='store_true')
 parser.add_argument('--peft', action='store_true')
 parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
 parser.add_argument('--no_eot', action='store_true')
+parser.add_argument('--batch_size', type=int, default=64, help='sentences to decode at once')
+inference.add_arguments(parser)
 parser.add_argument('ckpt_path')
 parser.add_argument('infile', type=argparse.FileType("r"))
 args = parser.parse_args()
 
 device = args.device
 torch.manual_seed(args.seed)
-torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
-torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+inference.setup(args)
 
-checkpoint = torch.load(args.ckpt_path, map_location=device)
+checkpoint = checkpoints.load(args.ckpt_path)
 
 # model
 gptconf = GPTConfig(**checkpoint['model_args'])
@@ -71,11 +79,10 @@ elif args.lora:
     model.load_state_dict(checkpoint['model'])
 
 else:
-    model = nn.ModuleDict({'_orig_mod': GPT(gptconf)})
-    model = model._orig_mod
-    model = torch.compile(model) # requires PyTorch 2.0
+    model = checkpoints.build_model(gptconf, checkpoint['model'])
 
-    model.load_state_dict(checkpoint['model'])
+    if inference.should_compile(args):
+        model = torch.compile(model) # requires PyTorch 2.0
 
 model.eval()
 model.to(device)
@@ -84,17 +91,28 @@ model.to(device)
 sp = spm.SentencePieceProcessor(model_file=args.spm)
 
 
-def generate_step(self, idx, temperature=1.0, top_k=None):
+def generate_step(self, idx, past=None, temperature=1.0, top_k=None, logits_processor=None):
     """
     Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
-    the sequence 1 time
+    the sequence 1 time. past is the key/value cache of a prefix of idx returned by
+    the previous step, only the positions of idx after it are forwarded.
+    logits_processor is called with the logits of the final step and the whole idx.
     """
-    # if the sequence context is growing too long we must crop it at block_size
-    idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-    # forward the model to get the logits for the index in the sequence
-    logits, _ = self(idx_cond)
-    # pluck the logits at the final step and scale by desired temperature
-    logits = logits[:, -1, :] / temperature
+    if idx.size(1) > self.config.block_size:
+        # if the sequence context is growing too long we must crop it at block_size
+        idx_cond, past = idx[:, -self.config.block_size:], None
+        logits, _ = self(idx_cond)
+    else:
+        # forward the model to get the logits for the index in the sequence
+        past_length = 0 if past is None else past[0].size(-2)
+        logits, _, past = self(idx[:, past_length:], past=past, use_cache=True)
+    # pluck the logits at the final step
+    logits = logits[:, -1, :]
+    # optionally penalize repetitions, mask eos and so on
+    if logits_processor is not None:
+        logits = logits_processor(logits, idx)
+    # scale by desired temperature
+    logits = logits / temperature
     # optionally crop the logits to only the top k options
     if top_k is not None:
         v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
@@ -106,7 +124,7 @@ def generate_step(self, idx, temperature=1.0, top_k=None):
     # append sampled index to the running sequence and continue
     idx = torch.cat((idx, idx_next), dim=1)
 
-    return idx
+    return idx, past
 
 
 def encode_idx(text, prefix=[], suffix=[]):
@@ -117,22 +135,29 @@ def encode_idx(text, prefix=[], suffix=[]):
 
 @torch.inference_mode()
 def ner_decode(self, constraint_tokens, prompt, temperature=1.0, top_k=1):
+    """
+    Decode one sentence re-running generate_step after every word, used for sentences longer than block_size.
+    """
     if args.no_eot:
         idx = start = encode_idx(prompt)
     else:
         idx = start = encode_idx(prompt, prefix=[50256])
 
-    with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
-        idx = generate_step(self, idx, top_k=1)
+    with inference.autocast(device):
+        idx, past = generate_step(self, idx, top_k=1)
+
+        for token in constraint_tokens[1:]:
+            #print(sp.decode(idx[0].tolist()))
+            idx = torch.cat((idx, encode_idx(token)), dim=1)
+            #idx = generate_step(self, idx, top_k=1) # /  # [1]
+            idx, past = generate_step(self, idx, past=past, top_k=1) # tok
+
+    throughput.add(idx.size(1), sentences=1)
+    print_decoded(idx[0].tolist(), start.size(1))
 
-    for token in constraint_tokens[1:]:
-        #print(sp.decode(idx[0].tolist()))
-        idx = torch.cat((idx, encode_idx(token)), dim=1)
-        #idx = generate_step(self, idx, top_k=1) # /  # [1]
-        idx = generate_step(self, idx, top_k=1) # tok
 
-    idx = idx[0].tolist()
-    prefix, gen = idx[:len(start)], idx[len(start):]
+def print_decoded(idx, start_length):
+    prefix, gen = idx[:start_length], idx[start_length:]
     try:
         eot = gen.index(50256)
         gen = gen[:eot]
@@ -145,6 +170,28 @@ def ner_decode(self, constraint_tokens, prompt, temperature=1.0, top_k=1):
     print()
 
 
+def ner_segments(constraint_tokens, prompt):
+    "known tokens before every tag slot: the prompt up to the first /, then each following word with its /"
+    start = sp.encode(prompt) if args.no_eot else [50256] + sp.encode(prompt)
+    return [start] + [sp.encode(token) for token in constraint_tokens[1:]]
+
+
+def ner_decode_batch(self, segments):
+    """
+    Decode a batch of sentences given by their ner_segments at once.
+    Every step runs under autocast like in ner_decode. Returns (tokens, prompt length) per sentence.
+    """
+    tags = decode_slots(self, segments, autocast=lambda: inference.autocast(device))
+    results = []
+    for segment, tag in zip(segments, tags):
+        idx = []
+        for s, t in zip(segment, tag):
+            idx += s + [t]
+        throughput.add(len(idx), sentences=1)
+        results.append((idx, len(segment[0])))
+    return results
+
+
 def convert_sentence_inline(sentence: List[str],
                             prefix_text: str = "",
                             annotation: str = "анотація:",
@@ -185,14 +232,31 @@ def convert_sentence_inline(sentence: List[str],
     return constraint_tokens, prompt
         
 
+sentences = []
 accum = []
 for line in map(str.strip, args.infile):
     if not line.strip():
         if accum:
-            constraint_tokens, prompt = convert_sentence_inline(accum, test=True)
-            ner_decode(model, constraint_tokens, prompt)
+            sentences.append(convert_sentence_inline(accum, test=True))
             accum = []
     else:
         accum.append(line)
 
+throughput = inference.Throughput(device)
+segments = [ner_segments(*sentence) for sentence in sentences]
+# tokens with all tags filled in, longer sentences than block_size take the slow path
+lengths = [sum(map(len, s)) + len(s) for s in segments]
+order = sorted((i for i in range(len(sentences)) if lengths[i] <= model.config.block_size), key=lambda i: lengths[i])
+decoded = [None] * len(sentences)
+for k in range(0, len(order), args.batch_size):
+    batch = order[k:k+args.batch_size]
+    for i, result in zip(batch, ner_decode_batch(model, [segments[i] for i in batch])):
+        decoded[i] = result
+
+for sentence, result in zip(sentences, decoded):
+    if result is None:
+        ner_decode(model, *sentence)
+    else:
+        print_decoded(*result)
 
+throughput.report()
@@ -8,6 +8,8 @@ import sentencepiece as spm
 from datasets import load_dataset, Value, Features
 from tqdm import tqdm
 
+from documents import write_index
+
 parser = argparse.ArgumentParser('prepare')
 parser.add_argument('--name', type=str, required=True)
 parser.add_argument('--train', type=str, nargs='+')
@@ -44,12 +46,10 @@ tokenized = split_dataset.map(
     num_proc=num_proc,
 )
 
-# shuffle documents to avoid back to back paragraphs with different edits
-shuffled = tokenized.shuffle(seed=1337)
-
 # concatenate all the ids in each dataset into one large file we can use for training
 for split, dset in tokenized.items():
-    arr_len = np.sum(dset['len'])
+    lengths = np.asarray(dset['len'])
+    arr_len = np.sum(lengths)
     # preallocate space in a temporary file to store the concatenated ids
     filename = f'{args.name}_{split}_wiki.bin'
     arr = np.memmap(filename, dtype=np.uint16, mode='w+', shape=(arr_len,))
@@ -64,3 +64,5 @@ for split, dset in tokenized.items():
          arr[idx : idx + len(arr_batch)] = arr_batch
          idx += len(arr_batch)
     arr.flush()
+    # document starts, documents.Documents reads them for random access and shuffled order
+    write_index(filename, lengths)
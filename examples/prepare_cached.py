@@ -0,0 +1,70 @@
+# incremental dataset builds: every input file is tokenized once into a shard cached under
+# the hash of its content and of the sentencepiece model, the .bin and its .bin.idx
+# are assembled by concatenating the shards in the order of the inputs.
+# Adding a file to a corpus costs its own tokenization and one sequential copy of the rest.
+#
+# $ python -m prepare_cached --cache_dir exp/cache data/*.txt exp/corpus/train.bin
+
+import argparse
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import sys
+
+import numpy as np
+
+from checkpoints import file_hash
+from documents import index_path
+from prepare_stream import prepare
+
+parser = argparse.ArgumentParser('prepare cached')
+parser.add_argument('--cache_dir', type=Path, default=Path('exp/cache'))
+parser.add_argument('--num_proc', type=int, default=24)
+parser.add_argument('--chunk_size', type=int, default=4096, help='paragraphs per task')
+parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
+parser.add_argument('txt', type=str, nargs='+')
+parser.add_argument('bin', type=str)
+
+
+def shard(txt, cache_dir, spm_hash, **kwargs):
+    "path of the cached tokens of txt, tokenizing it unless they are cached already"
+    key = hashlib.sha1(f'{file_hash(txt)} {spm_hash}'.encode()).hexdigest()
+    path = str(cache_dir / f'{key}.bin')
+    if os.path.exists(path) and os.path.exists(index_path(path)):
+        print(f'cached {txt}: {path}', file=sys.stderr)
+        return path
+
+    # shards only get their final name once complete, an interrupted one resumes under the temporary name
+    partial = path + '.partial'
+    print(f'tokenizing {txt} into {path}', file=sys.stderr)
+    prepare([txt], partial, **kwargs)
+    os.replace(index_path(partial), index_path(path))
+    os.replace(partial, path)
+    return path
+
+
+def concat(shards, bin):
+    "the tokens of shards one after another and the document index with shifted offsets"
+    with open(bin, 'wb') as out:
+        for path in shards:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, 16<<20)
+
+    with open(index_path(bin), 'wb') as out:
+        total = 0
+        out.write(np.zeros(1, dtype=np.int64).tobytes())
+        for path in shards:
+            offsets = np.fromfile(index_path(path), dtype=np.int64)
+            out.write((total + offsets[1:]).tobytes())
+            total += int(offsets[-1])
+    print(f'wrote {total} tokens of {len(shards)} shards to {bin}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cache_dir.mkdir(parents=True, exist_ok=True)
+    spm_hash = file_hash(args.spm)
+    shards = [shard(txt, args.cache_dir, spm_hash, num_proc=args.num_proc, chunk_size=args.chunk_size, model_file=args.spm)
+              for txt in args.txt]
+    concat(shards, args.bin)
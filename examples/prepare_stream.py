@@ -0,0 +1,160 @@
+# streams text files into a token .bin for training without a datasets cache:
+# worker processes tokenize chunks of paragraphs, the main process appends them in order
+# to the .bin and its .bin.idx document index (see documents.py) holding at most a few chunks in memory.
+#
+# Progress is recorded in <bin>.progress after every chunk. Rerunning the same command
+# after an interruption truncates the partial writes and continues with the next chunk.
+#
+# $ python -m prepare_stream --num_proc 24 ubertext.*.txt exp/ubertext/train.bin
+
+import argparse
+from collections import defaultdict, deque
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import sentencepiece as spm
+
+from documents import index_path
+
+parser = argparse.ArgumentParser('prepare stream')
+parser.add_argument('--num_proc', type=int, default=24)
+parser.add_argument('--chunk_size', type=int, default=4096, help='paragraphs per task')
+parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
+parser.add_argument('--report_every', type=int, default=100, help='report tokens/s every this many chunks')
+parser.add_argument('txt', type=str, nargs='+')
+parser.add_argument('bin', type=str)
+
+
+class Tok:
+    endoftext = 50256
+
+
+def paragraphs(paths, block_size=1<<20):
+    "paragraphs separated by empty lines, as load_dataset('text', sample_by='paragraph') splits them"
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            rest = ''
+            while block := f.read(block_size):
+                parts = (rest + block).split('\n\n')
+                rest = parts.pop()
+                yield from filter(None, parts) # runs of empty lines are not documents
+            if rest:
+                yield rest
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def init_worker(model_file):
+    global sp
+    sp = spm.SentencePieceProcessor(model_file=model_file)
+
+
+def tokenize(texts):
+    start = time.time()
+    docs = [ids + [Tok.endoftext] for ids in sp.encode(texts)]
+    lengths = np.array([len(ids) for ids in docs], dtype=np.int64)
+    tokens = np.fromiter((i for ids in docs for i in ids), dtype=np.uint16, count=int(lengths.sum()))
+    return tokens, lengths, os.getpid(), time.time() - start
+
+
+def per_worker(worker_tokens, busy):
+    "tokens/s of every worker while it was tokenizing"
+    return ' '.join(f'{worker_tokens[pid] / max(busy[pid], 1e-9):.0f}' for pid in sorted(busy))
+
+
+def load_progress(progress_path, progress):
+    "chunks written by a previous run of the same command, and the tokens and documents they hold"
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            saved = json.load(f)
+        if all(saved[key] == progress[key] for key in ('txt', 'chunk_size', 'spm')):
+            return saved
+        print(f'{progress_path} is from a different command, starting over', file=sys.stderr)
+    return progress
+
+
+def save_progress(progress_path, progress):
+    with open(progress_path + '.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.replace(progress_path + '.tmp', progress_path)
+
+
+def prepare(txt, bin, num_proc=24, chunk_size=4096, model_file='wiki.model', report_every=100):
+    "tokenize the paragraphs of txt files into bin and its document index"
+    progress_path = bin + '.progress'
+    progress = {'txt': txt, 'chunk_size': chunk_size, 'spm': model_file, 'chunks': 0, 'tokens': 0, 'documents': 0}
+    if os.path.exists(bin):
+        progress = load_progress(progress_path, progress)
+    if progress['chunks']:
+        print(f"resuming after chunk {progress['chunks']} with {progress['tokens']} tokens", file=sys.stderr)
+
+    # drop whatever was appended after the last recorded chunk
+    bin_file = open(bin, 'r+b' if progress['chunks'] else 'wb')
+    bin_file.truncate(progress['tokens'] * np.dtype(np.uint16).itemsize)
+    bin_file.seek(0, os.SEEK_END)
+    idx_file = open(index_path(bin), 'r+b' if progress['chunks'] else 'wb')
+    idx_file.truncate((progress['documents'] + 1) * np.dtype(np.int64).itemsize)
+    idx_file.seek(0)
+    idx_file.write(np.zeros(1, dtype=np.int64).tobytes()) # the first document starts at 0
+    idx_file.seek(0, os.SEEK_END)
+
+    todo = chunks(paragraphs(txt), chunk_size)
+    for _ in range(progress['chunks']):
+        next(todo) # already tokenized
+
+    busy, worker_tokens = defaultdict(float), defaultdict(int)
+    start = time.time()
+    written = 0
+    with multiprocessing.Pool(num_proc, initializer=init_worker, initargs=(model_file,)) as pool:
+        # keep a bounded number of chunks in flight and write them in input order
+        pending = deque()
+        while True:
+            while len(pending) < 2 * num_proc:
+                chunk = next(todo, None)
+                if chunk is None:
+                    break
+                pending.append(pool.apply_async(tokenize, (chunk,)))
+            if not pending:
+                break
+
+            tokens, lengths, pid, seconds = pending.popleft().get()
+            bin_file.write(tokens.tobytes())
+            idx_file.write((progress['tokens'] + np.cumsum(lengths)).tobytes())
+            bin_file.flush()
+            idx_file.flush()
+            progress['chunks'] += 1
+            progress['tokens'] += int(lengths.sum())
+            progress['documents'] += len(lengths)
+            save_progress(progress_path, progress)
+
+            busy[pid] += seconds
+            worker_tokens[pid] += len(tokens)
+            written += len(tokens)
+            if progress['chunks'] % report_every == 0:
+                print(f"chunk {progress['chunks']}: {progress['tokens']} tokens, {written / (time.time() - start):.0f} tokens/s, "
+                      f"per worker tokens/s: {per_worker(worker_tokens, busy)}", file=sys.stderr)
+
+    bin_file.close()
+    idx_file.close()
+    if os.path.exists(progress_path):
+        os.remove(progress_path) # done, a rerun starts over
+    print(f"wrote {progress['tokens']} tokens of {progress['documents']} documents to {bin}, "
+          f"{written / (time.time() - start):.0f} tokens/s, per worker tokens/s: {per_worker(worker_tokens, busy)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    prepare(args.txt, args.bin, num_proc=args.num_proc, chunk_size=args.chunk_size, model_file=args.spm, report_every=args.report_every)
@@ -0,0 +1,102 @@
+"""
+Convert a checkpoint to int8 Linear weights with dynamically quantized activations for CPU inference.
+Optionally score sentences with both the float32 and the int8 model and report the BPC delta.
+
+$ python -m quantize exp/uk4b_medium/ckpt.pt exp/uk4b_medium/int8.pt --sentences data/flair-ppl/bruk.sentences.combined.txt
+
+score.py and sample.py load the written checkpoint like any other, on CPU only.
+"""
+import argparse
+import math
+from pathlib import Path
+import sys
+
+import torch
+import torch.nn as nn
+import sentencepiece as spm
+
+from model import GPTConfig
+import inference
+import checkpoints
+
+
+def quantize(model):
+    """
+    int8 weights for every nn.Linear of the model: c_attn, c_proj, c_fc and lm_head.
+    Activations are quantized on the fly, the embeddings and layer norms stay in float32.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def dynamic_linears(model):
+    "replace every nn.Linear of a (meta) model with an empty int8 dynamic Linear for the weights of a quantized checkpoint"
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, name, torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features, child.out_features, bias_=child.bias is not None, dtype=torch.qint8))
+
+
+def load_quantized(checkpoint):
+    "Build a model from a checkpoint written by this script, the float32 weights are never initialized."
+    return checkpoints.build_model(GPTConfig(**checkpoint['model_args']), checkpoint['model'], prepare=dynamic_linears)
+
+
+@torch.inference_mode()
+def bpc(model, sentences, sp, throughput):
+    "bits per character of sentences, as scripts/evaluate_nll.py computes it from score.py --tsv"
+    nll, chars = 0., 0
+    for sentence in sentences:
+        x = torch.tensor([50256] + sp.encode(sentence), dtype=torch.long)[None, ...]
+        y, _ = model(x, decode_full=True)
+        nll += nn.functional.cross_entropy(y[0, :-1, :].float(), x[0, 1:], reduction='sum').item()
+        chars += len(sentence)
+        throughput.add(x.numel())
+    return nll / math.log(2) / chars
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('quantize')
+    parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
+    parser.add_argument('--sentences', type=Path, help='report the BPC delta against float32 on these sentences')
+    parser.add_argument('--limit', type=int, default=0, help='only score this many sentences')
+    inference.add_arguments(parser)
+    parser.add_argument('ckpt_path', type=Path)
+    parser.add_argument('out_path', type=Path)
+    args = parser.parse_args()
+    args.device = 'cpu'
+    inference.setup(args)
+
+    checkpoint = checkpoints.load(args.ckpt_path)
+    if checkpoint.get('quantized'):
+        parser.error(f'{args.ckpt_path} is already quantized')
+    if any('lora_' in k for k in checkpoint['model']):
+        parser.error(f'{args.ckpt_path} has LoRA adapters, merge them into the base weights first')
+    if not 'vocab_size' in checkpoint['model_args']:
+        print('WARNING: vocab_size not found in checkpoint["model_args"], assuming 50257', file=sys.stderr)
+        checkpoint['model_args']['vocab_size'] = 50257
+
+    model = checkpoints.build_model(GPTConfig(**checkpoint['model_args']), checkpoint['model'], strict=False)
+    model.eval()
+    qmodel = quantize(model)
+
+    torch.save({
+        'model': qmodel.state_dict(),
+        'model_args': checkpoint['model_args'],
+        'quantized': 'dynamic_int8',
+    }, args.out_path)
+    print(f'wrote {args.out_path}', file=sys.stderr)
+
+    if args.sentences:
+        sp = spm.SentencePieceProcessor(model_file=args.spm)
+        sentences = [s for s in map(str.strip, args.sentences.read_text().split("\n")) if s]
+        if args.limit:
+            sentences = sentences[:args.limit]
+
+        results = {}
+        for name, m in [('float32', model), ('int8', qmodel)]:
+            throughput = inference.Throughput('cpu')
+            results[name] = bpc(m, sentences, sp, throughput)
+            print(name, 'bpc', results[name], sep='\t')
+            throughput.report()
+        print('delta', 'bpc', results['int8'] - results['float32'], sep='\t')
@@ -6,10 +6,15 @@ from pathlib import Path
 import torch
 import torch.nn as nn
 from model import GPTConfig, GPT
+import inference
+import checkpoints
+from logits_processors import LogitsProcessor
 import sentencepiece as spm
 import sys
 from termcolor import colored
 import itertools
+import time
+import speculative
 
 
 parser = argparse.ArgumentParser('sample')
@@ -20,6 +25,15 @@ parser.add_argument('--lora', action='store_true')
 parser.add_argument('--peft', action='store_true')
 parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
 parser.add_argument('--no_eot', action='store_true')
+parser.add_argument('--min_length', type=int, default=0, help='min tokens to generate')
+parser.add_argument('--no_repeat_ngram_size', type=int, default=0, help='no_repeat_ngram_size')
+parser.add_argument('--repetition_penalty', type=float, default=1.0, help='repetition_penalty')
+parser.add_argument('--temperature', type=float, default=1.0)
+parser.add_argument('--top_k', type=int, default=1, help='sample from the k most likely tokens, 1 is greedy, 0 samples from all')
+parser.add_argument('--draft', type=str, help='checkpoint of a smaller model to draft tokens for speculative decoding, e.g. exp/uk4b_small/ckpt.pt')
+parser.add_argument('--draft_k', type=int, default=4, help='tokens drafted per forward of the model in ckpt_path')
+parser.add_argument('--baseline', action='store_true', help='also generate without the draft model to measure the speedup')
+inference.add_arguments(parser)
 parser.add_argument('ckpt_path')
 parser.add_argument('--paragraphs', nargs='*', help='files with paragraphs to score', type=Path)
 parser.add_argument('prompts', nargs='*')
@@ -27,15 +41,22 @@ args = parser.parse_args()
 
 device = args.device
 torch.manual_seed(args.seed)
-torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
-torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+inference.setup(args)
 
-checkpoint = torch.load(args.ckpt_path, map_location=device)
+checkpoint = checkpoints.load(args.ckpt_path)
 
 # model
 gptconf = GPTConfig(**checkpoint['model_args'])
-
-if args.peft:
+ptdtype = torch.bfloat16
+
+if checkpoint.get('quantized'):
+    # written by quantize.py: int8 Linear weights, activations quantized on the fly on CPU
+    if inference.device_type(device) != 'cpu':
+        parser.error(f'{args.ckpt_path} is quantized for CPU inference, use --device cpu')
+    from quantize import load_quantized
+    model = load_quantized(checkpoint)
+    ptdtype = torch.float32 # quantized Linear layers take float32 activations
+elif args.peft:
     model = GPT(gptconf)
 
     from peft import get_peft_model, LoraConfig, TaskType
@@ -67,18 +88,45 @@ elif args.lora:
     model.load_state_dict(checkpoint['model'])
 
 else:
-    model = nn.ModuleDict({'_orig_mod': GPT(gptconf)})
-    model = model._orig_mod
-    model = torch.compile(model) # requires PyTorch 2.0
+    model = checkpoints.build_model(gptconf, checkpoint['model'])
 
-    model.load_state_dict(checkpoint['model'])
+    if inference.should_compile(args):
+        model = torch.compile(model) # requires PyTorch 2.0
 
 model.eval()
 model.to(device)
 
+draft = None
+if args.draft:
+    draft_checkpoint = checkpoints.load(args.draft)
+    draft = checkpoints.build_model(GPTConfig(**draft_checkpoint['model_args']), draft_checkpoint['model'])
+    draft.eval()
+    draft.to(device)
+
+
+def timed(fn):
+    "returns fn() and the seconds it took"
+    if inference.device_type(device) == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    result = fn()
+    if inference.device_type(device) == 'cuda':
+        torch.cuda.synchronize(device)
+    return result, time.time() - start
+
 
 sp = spm.SentencePieceProcessor(model_file=args.spm)
 
+throughput = inference.Throughput(device)
+stats = {'drafted': 0, 'accepted': 0, 'target_forwards': 0, 'seconds': 0., 'baseline_seconds': 0., 'greedy_mismatches': 0}
+
+process_logits = LogitsProcessor(
+    repetition_penalty=args.repetition_penalty,
+    no_repeat_ngram_size=args.no_repeat_ngram_size,
+    min_length=args.min_length,
+    eos_token_id=[50256],
+)
+
 for i, prompt in enumerate(itertools.chain(args.prompts,
                               *(f.read_text().split("\n\n") for f in args.paragraphs or []))):
     if args.no_eot:
@@ -87,10 +135,23 @@ for i, prompt in enumerate(itertools.chain(args.prompts,
         start = [50256] + sp.encode(prompt)
     x = (torch.tensor(start, dtype=torch.long, device=device)[None, ...])
 
+    generate = lambda: GPT.generate(model, x, steps=args.steps, temperature=args.temperature, top_k=args.top_k or None,
+                                    logits_processor=process_logits)
     with torch.inference_mode():
-        with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
-            y = GPT.generate(model, x, steps=args.steps, temperature=1, top_k=1)
-
+        with inference.autocast(device, ptdtype):
+            if draft is None:
+                y = generate()
+            else:
+                y, elapsed = timed(lambda: speculative.generate(model, draft, x, steps=args.steps, k=args.draft_k,
+                                                                temperature=args.temperature, top_k=args.top_k or None,
+                                                                logits_processor=process_logits, stats=stats))
+                stats['seconds'] += elapsed
+                if args.baseline:
+                    y_baseline, elapsed = timed(generate)
+                    stats['baseline_seconds'] += elapsed
+                    stats['greedy_mismatches'] += args.top_k == 1 and not torch.equal(y, y_baseline)
+
+    throughput.add(len(y[0]))
     y = y[0].tolist()
     prefix, gen = y[:len(start)], y[len(start):]
     try:
@@ -102,4 +163,13 @@ for i, prompt in enumerate(itertools.chain(args.prompts,
     #print([sp.id_to_piece(i) for i in start], file=sys.stderr)
     prefix, gen = sp.decode(prefix), sp.decode(gen)
     print(prefix, colored(gen, "magenta"), sep='')
-    print()
\ No newline at end of file
+    print()
+
+throughput.report()
+if draft is not None:
+    print(f"speculative decoding: {stats['accepted']}/{stats['drafted']} drafted tokens accepted "
+          f"({stats['accepted'] / max(stats['drafted'], 1):.1%}), "
+          f"{stats['target_forwards']} forwards of the target model in {stats['seconds']:.2f}s", file=sys.stderr)
+    if args.baseline:
+        print(f"speedup {stats['baseline_seconds'] / stats['seconds']:.2f}x over {stats['baseline_seconds']:.2f}s without the draft model"
+              + (f", {stats['greedy_mismatches']} greedy outputs differ" if args.top_k == 1 else ''), file=sys.stderr)
\ No newline at end of file
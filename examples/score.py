@@ -14,6 +14,8 @@ import sentencepiece as spm
 from termcolor import colored
 
 from model import GPTConfig, GPT
+import inference
+import checkpoints
 
 
 parser = argparse.ArgumentParser('sample')
@@ -26,22 +28,28 @@ parser.add_argument('--tsv', action='store_true', help='output tsv')
 parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
 parser.add_argument('--no_eot', action='store_true')
 parser.add_argument('--seq_len', type=int, default=1024)
-parser.add_argument('--paragraphs', nargs='*', help='files with paragraphs to score', type=Path)
-parser.add_argument('--sentences', nargs='*', help='files with sentences to score', type=Path)
+parser.add_argument('--batch_size', type=int, default=1, help='score this many inputs of similar length at once, more than 1 reads and encodes all inputs before scoring')
+parser.add_argument('--chunk_size', type=int, default=0, help='project onto the vocabulary this many positions at a time instead of materializing all logits')
+parser.add_argument('--stride', type=int, default=0, help='score inputs longer than --seq_len with windows moved by this many tokens instead of truncating them')
+parser.add_argument('--paragraphs', nargs='*', help='files with paragraphs to score, prefix with NAME: to score them with an adapter', type=Path)
+parser.add_argument('--sentences', nargs='*', help='files with sentences to score, prefix with NAME: to score them with an adapter', type=Path)
+parser.add_argument('--adapters', nargs='*', default=[], metavar='NAME=CKPT', help='LoRA checkpoints to serve on top of the base model in ckpt_path')
 parser.add_argument('--ids', action='store_true', help='output integer ids')
 parser.add_argument('--pieces', action='store_true', help='output pieces')
 parser.add_argument('--unblank', action='store_true', help='replace blank tokens with the token with the highest probability')
 parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
+inference.add_arguments(parser)
 parser.add_argument('ckpt_path')
 parser.add_argument('prompts', nargs='*')
 args = parser.parse_args()
+if args.stride and not 0 < args.stride < args.seq_len:
+    parser.error('--stride must be between 0 and --seq_len')
 
 device = args.device
 torch.manual_seed(args.seed)
-torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
-torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+inference.setup(args)
 
-checkpoint = torch.load(args.ckpt_path, map_location=device)
+checkpoint = checkpoints.load(args.ckpt_path)
 
 # model
 if not 'vocab_size' in checkpoint['model_args']:
@@ -51,8 +59,16 @@ if not 'vocab_size' in checkpoint['model_args']:
 else:
     vocab_size = checkpoint['model_args']['vocab_size']
 gptconf = GPTConfig(**checkpoint['model_args'])
+ptdtype = torch.bfloat16
 
-if args.peft:
+if checkpoint.get('quantized'):
+    # written by quantize.py: int8 Linear weights, activations quantized on the fly on CPU
+    if inference.device_type(device) != 'cpu':
+        parser.error(f'{args.ckpt_path} is quantized for CPU inference, use --device cpu')
+    from quantize import load_quantized
+    model = load_quantized(checkpoint)
+    ptdtype = torch.float32 # quantized Linear layers take float32 activations
+elif args.peft:
     model = GPT(gptconf)
 
     from peft import get_peft_model, LoraConfig, TaskType
@@ -86,14 +102,22 @@ elif args.lora:
     model.to(device)
 else:
     print(gptconf, file=sys.stderr)
-    model = nn.ModuleDict({'_orig_mod': GPT(gptconf)})
-    model = model._orig_mod
-    print('compiling model', file=sys.stderr)
-    #model = torch.compile(model, mode='reduce-overhead') # requires PyTorch 2.0
-    model = torch.compile(model) # requires PyTorch 2.0
-    print('done compiling model', file=sys.stderr)
+    model = checkpoints.build_model(gptconf, checkpoint['model'], strict=False)
 
-    model.load_state_dict(checkpoint['model'], strict=False)
+    if inference.should_compile(args):
+        print('compiling model', file=sys.stderr)
+        #model = torch.compile(model, mode='reduce-overhead') # requires PyTorch 2.0
+        model = torch.compile(model) # requires PyTorch 2.0
+        print('done compiling model', file=sys.stderr)
+
+adapters = None
+if args.adapters:
+    from adapters import Adapters
+    adapters = Adapters(getattr(model, '_orig_mod', model)) # compilation is lazy, swapping c_attn is still fine
+    for spec in args.adapters:
+        name, _, path = spec.partition('=')
+        adapters.load(name, checkpoints.load(path)['model'])
+    print(f'loaded adapters {adapters.names[1:]}, {adapters.nbytes() / 2**20:.1f} MiB', file=sys.stderr)
 
 model.eval()
 model.to(device)
@@ -101,54 +125,133 @@ model.to(device)
 
 sp = spm.SentencePieceProcessor(model_file=args.spm)
 
-if args.tsv:
-    print('id', 'sentence' , 'ppl', 'sentence_len', sep='\t')
 
-for i, prompt in enumerate(itertools.chain(args.prompts,
-                              *(f.read_text().split("\n\n") for f in args.paragraphs or []),
-                              *(f.read_text().split("\n") for f in args.sentences or []))):
-    prompt = prompt.strip()
+
+def encode(i, prompt):
     print(i, 'prompt:', prompt, file=sys.stderr)
     if args.no_eot:
         start = sp.encode(prompt)
     else:
         start = [50256] + sp.encode(prompt)
 
-    length = len(start)
-
-    if length > args.seq_len:
+    if len(start) > args.seq_len and not args.stride:
         start = start[-args.seq_len:] # truncate very long sequences from the beginning
-        length = args.seq_len
         print(colored('truncated', 'red'), prompt, file=sys.stderr)
 
-    x = torch.tensor(start, dtype=torch.long, device=device)[None, ...]
+    return start
 
-    with torch.inference_mode():
-        with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
+
+def select_adapters(adapter_ids):
+    "rows of the next forward pass run with these adapters, they may differ from row to row"
+    if adapters is not None:
+        adapters.select(torch.tensor(adapter_ids, dtype=torch.long))
+
+
+@torch.inference_mode()
+def score_batch(starts, adapter_ids):
+    """
+    Score token sequences of similar lengths in one forward pass.
+    Sequences are padded on the right: causal attention never lets real tokens see the padding,
+    and the loss of every sequence is summed over its own positions only.
+    Returns a list of (log_prob, sequence) per sequence.
+    """
+    select_adapters(adapter_ids)
+    x = torch.full((len(starts), max(map(len, starts))), 50256, dtype=torch.long)
+    for b, start in enumerate(starts):
+        x[b, :len(start)] = torch.tensor(start, dtype=torch.long)
+    x = x.to(device)
+    throughput.add(x.numel())
+    sequence = x[:, 1:] # output eats the first token
+    blank = 50229 # _    
+
+    if args.chunk_size:
+        with inference.autocast(device, ptdtype):
+            log_probs, best_tok_pointwise = model.score(x[:, :-1], sequence, chunk_size=args.chunk_size,
+                                                        blank=blank if args.unblank else None)
+        if args.unblank:
+            sequence = torch.where(sequence == blank, best_tok_pointwise, sequence)
+    else:
+        with inference.autocast(device, ptdtype):
             y, _ = model(x, decode_full=True)
 
-    output_length = length - 1 # output eats the first token
-    y = y[:, :output_length, :] 
-    sequence = x[0, 1:]
-    
-    if args.tsv:
-        id = sha1(prompt.encode("utf-8")).hexdigest()
-        print(id, prompt, sep='\t', end='\t')
+        y = y[:, :-1, :]
 
-    if args.verbose:
-        print(colored(output_length, 'green'), end=' ')
+        if args.unblank:
+            best_tok_pointwise = y.argmax(-1)
+            sequence = torch.where(sequence == blank, best_tok_pointwise, sequence)
+
+        log_probs = nn.functional.cross_entropy(y.reshape(-1, vocab_size), sequence.reshape(-1), reduction='none').view_as(sequence)
 
-    if args.unblank:
+    results = []
+    for b, start in enumerate(starts):
+        output_length = len(start) - 1
+        results.append((log_probs[b, :output_length].sum(), sequence[b, :output_length]))
+    return results
+
+
+@torch.inference_mode()
+def score_strided(start, adapter_id):
+    """
+    Score a sequence of any length with windows of --seq_len tokens moved by --stride tokens.
+    Every window conditions on the seq_len - stride tokens before the ones it adds and counts the loss
+    of the added targets only, so each target is counted exactly once and memory stays bounded by the window.
+    Returns (log_prob, sequence) like score_batch, the log_prob is accumulated in float32.
+    """
+    select_adapters([adapter_id])
+    x = torch.tensor(start, dtype=torch.long, device=device)[None, ...]
+
+    log_prob = torch.zeros((), dtype=torch.float32, device=device)
+    sequences = []
+    scored = 1 # targets that have been counted, the first token is never predicted
+    for begin in range(0, x.size(1), args.stride):
+        end = min(begin + args.seq_len, x.size(1))
+        window = x[:, begin:end]
+        throughput.add(window.numel())
+
+        new = end - scored # targets this window adds, they are at the end of the window
+        sequence = window[0, -new:]
         blank = 50229 # _    
-        best_tok_pointwise = y.argmax(-1)
-        sequence = torch.where(sequence == blank, best_tok_pointwise, sequence)
 
-    sequence = sequence.view(-1)
-    log_prob = nn.functional.cross_entropy(y.view(-1, vocab_size), sequence, reduction='none')[:output_length].sum()
+        if args.chunk_size:
+            with inference.autocast(device, ptdtype):
+                log_probs, best_tok_pointwise = model.score(window[:, :-1], window[:, 1:], chunk_size=args.chunk_size,
+                                                            blank=blank if args.unblank else None)
+            if args.unblank:
+                sequence = torch.where(sequence == blank, best_tok_pointwise[0, -new:], sequence)
+            log_prob += log_probs[0, -new:].float().sum()
+        else:
+            with inference.autocast(device, ptdtype):
+                y, _ = model(window, decode_full=True)
+
+            y = y[0, -new-1:-1, :]
+
+            if args.unblank:
+                sequence = torch.where(sequence == blank, y.argmax(-1), sequence)
+
+            log_prob += nn.functional.cross_entropy(y, sequence, reduction='none').float().sum()
+        sequences.append(sequence)
+        scored = end
+        if end == x.size(1):
+            break
+
+    return log_prob, torch.cat(sequences)
+
+
+def print_result(prompt, log_prob, sequence):
+    output_length = sequence.size(0)
+
+    if args.tsv:
+        id = sha1(prompt.encode("utf-8")).hexdigest()
+        print(id, prompt, sep='\t', end='\t')
 
     if args.verbose:
+        print(colored(output_length, 'green'), end=' ')
         print(colored(log_prob.item(), 'red'), end=' ')
 
+    global total_log_prob, total_length
+    total_log_prob += log_prob.item()
+    total_length += output_length
+
     sequence = sequence.tolist()
     
     if args.tsv:
@@ -162,3 +265,64 @@ for i, prompt in enumerate(itertools.chain(args.prompts,
 
     if args.paragraphs:
         print(flush=True)
+
+
+if args.tsv:
+    print('id', 'sentence' , 'ppl', 'sentence_len', sep='\t')
+
+def read_tagged(f, sep):
+    "inputs of a NAME:path file are scored with adapter NAME, prompts and untagged files with the base model"
+    name, tagged, path = str(f).partition(':')
+    if tagged and adapters is not None and name in adapters.names:
+        adapter_id, f = adapters.names.index(name), Path(path)
+    else:
+        adapter_id = 0
+    for text in f.read_text().split(sep): # read once the inputs before it are done
+        yield adapter_id, text
+
+def score_bucket(starts, adapter_ids):
+    "(log_prob, sequence) of every start, inputs longer than the window are only left untruncated with --stride"
+    results = [None] * len(starts)
+    short = [i for i, start in enumerate(starts) if len(start) <= args.seq_len]
+    if short:
+        for i, result in zip(short, score_batch([starts[i] for i in short], [adapter_ids[i] for i in short])):
+            results[i] = result
+    for i, start in enumerate(starts):
+        if len(start) > args.seq_len:
+            results[i] = score_strided(start, adapter_ids[i])
+    return results
+
+inputs = itertools.chain(((0, prompt) for prompt in args.prompts),
+                         *(read_tagged(f, "\n\n") for f in args.paragraphs or []),
+                         *(read_tagged(f, "\n") for f in args.sentences or []))
+throughput = inference.Throughput(device)
+total_log_prob, total_length = 0., 0
+
+if args.batch_size == 1:
+    # streaming: every input is encoded, scored and printed before the next one
+    for i, (adapter_id, prompt) in enumerate(inputs):
+        prompt = prompt.strip()
+        print_result(prompt, *score_bucket([encode(i, prompt)], [adapter_id])[0])
+else:
+    inputs = list(inputs)
+    prompts = [prompt.strip() for _, prompt in inputs]
+    adapter_of = [adapter_id for adapter_id, _ in inputs]
+    starts = [encode(i, prompt) for i, prompt in enumerate(prompts)]
+
+    # bucket sequences of similar lengths together to keep padding low, whatever adapter they use
+    order = sorted(range(len(starts)), key=lambda i: len(starts[i]))
+
+    # results are printed in the input order as soon as all preceding inputs are scored
+    results = [None] * len(starts)
+    printed = 0
+    for k in range(0, len(order), args.batch_size):
+        bucket = order[k:k+args.batch_size]
+        for i, result in zip(bucket, score_bucket([starts[i] for i in bucket], [adapter_of[i] for i in bucket])):
+            results[i] = result
+        while printed < len(results) and results[printed] is not None:
+            print_result(prompts[printed], *results[printed])
+            results[printed] = None
+            printed += 1
+
+print(f'total nll {total_log_prob:.4f} over {total_length} tokens', file=sys.stderr)
+throughput.report()
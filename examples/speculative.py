@@ -0,0 +1,105 @@
+"""
+Speculative decoding: a small draft model proposes k tokens, the target model scores all of them
+in a single forward pass and keeps the longest prefix it agrees with (https://arxiv.org/abs/2211.17192).
+
+Acceptance is randomized so that the tokens follow exactly the distribution of the target model
+under the same logits processing, temperature and top_k as GPT.generate. With top_k=1 the output
+is the greedy decoding of the target model alone, up to rounding differences between scoring
+several positions in one forward and one position at a time.
+"""
+import torch
+from torch.nn import functional as F
+
+
+def crop(past, length):
+    "drop the cached positions from length on"
+    return tuple(layer_past[..., :length, :] for layer_past in past)
+
+
+def next_token_probs(logits, history, temperature=1.0, top_k=None, logits_processor=None):
+    "the distribution GPT.generate samples from given logits (b, vocab) and the tokens generated so far"
+    if logits_processor is not None:
+        logits = logits_processor(logits, history)
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[:, [-1]]] = -float('Inf')
+    return F.softmax(logits.float(), dim=-1)
+
+
+def forward_cached(model, idx, past, n_last=1):
+    "logits for the last n_last positions of idx (1, t) and the cache extended with the positions it did not have yet"
+    past_length = 0 if past is None else past[0].size(-2)
+    x, past = model.hidden_states(idx[:, past_length:], past=past, use_cache=True)
+    return model.lm_head(x[:, -n_last:]), past # the prompt is never projected onto the vocabulary
+
+
+@torch.no_grad()
+def generate(target, draft, idx, steps, k=4, temperature=1.0, top_k=None, logits_processor=None, stats=None):
+    """
+    Like GPT.generate(target, idx, steps, ...) for a single sequence idx of shape (1, t),
+    with draft proposing k tokens per target forward. stats, a dict, accumulates the number of
+    drafted and accepted tokens and of target forwards.
+    """
+    assert idx.size(0) == 1, 'speculative decoding handles one sequence at a time'
+    assert target.config.vocab_size == draft.config.vocab_size, 'draft and target models must share the vocabulary'
+    block_size = min(target.config.block_size, draft.config.block_size)
+    stats = {} if stats is None else stats
+    for key in ('drafted', 'accepted', 'target_forwards'):
+        stats.setdefault(key, 0)
+    sample = lambda logits, history: next_token_probs(logits, history, temperature, top_k, logits_processor)
+
+    prompt_length = idx.size(1)
+    target_past, draft_past = None, None
+    while idx.size(1) - prompt_length < steps:
+        remaining = steps - (idx.size(1) - prompt_length)
+        n = min(k, remaining - 1)
+        if idx.size(1) + n + 1 > block_size:
+            # the window has to slide from here on, continue without caches like GPT.generate
+            logits, _ = target(idx[:, -target.config.block_size:])
+            probs = sample(logits[:, -1, :], idx[:, prompt_length:])
+            idx = torch.cat((idx, torch.multinomial(probs, num_samples=1)), dim=1)
+            stats['target_forwards'] += 1
+            continue
+
+        # draft n tokens one by one
+        start = idx.size(1)
+        draft_probs = []
+        for _ in range(n):
+            logits, draft_past = forward_cached(draft, idx, draft_past)
+            q = sample(logits[:, -1, :], idx[:, prompt_length:])
+            draft_probs.append(q)
+            idx = torch.cat((idx, torch.multinomial(q, num_samples=1)), dim=1)
+
+        # score the context and all drafts with the target at once, logits[:, -n-1+j] predict draft j
+        logits, target_past = forward_cached(target, idx, target_past, n_last=n + 1)
+        stats['target_forwards'] += 1
+        stats['drafted'] += n
+
+        accepted = 0
+        for j in range(n):
+            p = sample(logits[:, -n-1+j, :], idx[:, prompt_length:start+j])
+            q = draft_probs[j]
+            token = idx[0, start + j]
+            if torch.rand(()) * q[0, token] < p[0, token]:
+                accepted += 1
+                continue
+            # rejected: resample from the part of the target distribution the draft underestimates
+            residual = (p - q).clamp(min=0)
+            if residual.sum() == 0: # p and q only differ by rounding
+                residual = p
+            next_token = torch.multinomial(residual / residual.sum(), num_samples=1)
+            break
+        else:
+            # every draft is accepted, the target distribution after them comes for free
+            p = sample(logits[:, -1, :], idx[:, prompt_length:])
+            next_token = torch.multinomial(p, num_samples=1)
+        stats['accepted'] += accepted
+
+        idx = torch.cat((idx[:, :start + accepted], next_token), dim=1)
+        # keep the cached positions of accepted tokens only, the new token is forwarded next time
+        target_past = crop(target_past, idx.size(1) - 1)
+        if draft_past is not None:
+            draft_past = crop(draft_past, idx.size(1) - 1)
+
+    return idx
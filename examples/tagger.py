@@ -0,0 +1,173 @@
+"""
+Restricted-vocabulary tag decoding for the inline POS and NER formats
+
+    анотація: Речення /_ культурної /_ ...
+
+The words are known, only the tag after every / is not. Tags are decoded greedily left to right:
+every step forwards the tokens up to the next tag slot against the key/value cache of everything before it
+and projects the last hidden state onto the tag tokens only instead of the whole vocabulary.
+Many paragraphs are decoded in one batch, each step feeds their next segments left-padded to the same length.
+
+$ python -m tagger --lora exp/pos/ckpt.pt data/udpos/test.inline.gpt2.txt.blank > exp/pos/tag-test.txt
+"""
+import argparse
+from contextlib import nullcontext
+from pathlib import Path
+import string
+import sys
+
+import torch
+
+
+def tag_token_ids(sp, tags):
+    "vocabulary ids of the tags, tags that are not a single piece are dropped with a warning"
+    ids = []
+    for tag in tags:
+        id = sp.piece_to_id(tag)
+        if id == sp.unk_id():
+            print(f'WARNING: tag {tag!r} is not a piece of the vocabulary, skipping it', file=sys.stderr)
+        else:
+            ids.append(id)
+    return ids
+
+
+def split_slots(tokens, blank):
+    "split tokens at the blanks: the segments before every slot and the tail after the last one"
+    segments = [[]]
+    for token in tokens:
+        if token == blank:
+            segments.append([])
+        else:
+            segments[-1].append(token)
+    return segments
+
+
+@torch.inference_mode()
+def decode_slots(model, segments, tag_ids=None, pad=50256, autocast=nullcontext):
+    """
+    segments[b] lists the known token segments of row b, each of them is followed by a slot.
+    Fills the slots greedily left to right with the most likely of tag_ids (None allows the whole vocabulary)
+    given everything before the slot. All rows are decoded as one batch with a key/value cache
+    and leave the batch as soon as their slots are filled.
+    Returns the list of chosen tokens of every row.
+    """
+    head = model.lm_head.weight
+    device = head.device
+    if tag_ids is not None:
+        tag_ids = torch.tensor(tag_ids, dtype=torch.long, device=device)
+        head = head[tag_ids] # (n_tags, n_embd)
+
+    slots = [len(s) for s in segments]
+    tags = [[] for _ in segments]
+
+    rows = list(range(len(segments)))
+    past, attention_mask = None, None
+    for k in range(max(slots, default=0)):
+        keep = [j for j, b in enumerate(rows) if slots[b] > k]
+        if len(keep) < len(rows) and past is not None:
+            keep_index = torch.tensor(keep, dtype=torch.long, device=device)
+            past = tuple(layer_past[:, keep_index] for layer_past in past)
+            attention_mask = attention_mask[keep_index]
+        rows = [rows[j] for j in keep]
+
+        # the tag chosen at the previous slot followed by the known tokens up to this slot
+        inputs = [tags[b][-1:] + segments[b][k] for b in rows]
+        length = max(map(len, inputs))
+        x = torch.full((len(rows), length), pad, dtype=torch.long)
+        mask = torch.zeros((len(rows), length), dtype=torch.bool)
+        for j, tokens in enumerate(inputs):
+            # left padding keeps the slot at the last position of every row
+            x[j, length - len(tokens):] = torch.tensor(tokens, dtype=torch.long)
+            mask[j, length - len(tokens):] = True
+        x, mask = x.to(device), mask.to(device)
+        attention_mask = mask if attention_mask is None else torch.cat((attention_mask, mask), dim=1)
+
+        with autocast():
+            h, past = model.hidden_states(x, attention_mask=attention_mask, past=past, use_cache=True)
+            choice = (h[:, -1, :] @ head.t()).argmax(-1) # only the slots are projected
+        if tag_ids is not None:
+            choice = tag_ids[choice]
+        for b, tag in zip(rows, choice.tolist()):
+            tags[b].append(tag)
+
+    return tags
+
+
+def decode_tags(model, sequences, tag_ids, blank=50229, pad=50256, autocast=nullcontext):
+    """
+    Fill every blank of token sequences (lists of ids) with the most likely of tag_ids given the tokens
+    and the tags to its left. Returns the filled sequences.
+    """
+    segments = [split_slots(tokens, blank) for tokens in sequences]
+    tags = decode_slots(model, [s[:-1] for s in segments], tag_ids, pad=pad, autocast=autocast)
+
+    filled = []
+    for segment, tag in zip(segments, tags):
+        tokens = []
+        for s, t in zip(segment, tag):
+            tokens = tokens + s + [t]
+        filled.append(tokens + segment[-1])
+    return filled
+
+
+if __name__ == '__main__':
+    from model import GPTConfig, GPT
+    import inference
+    import checkpoints
+    import sentencepiece as spm
+
+    parser = argparse.ArgumentParser('tagger')
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--lora', action='store_true')
+    parser.add_argument('--spm', type=str, default='wiki.model', help='sentencepiece tokenizer')
+    parser.add_argument('--no_eot', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=64, help='paragraphs to decode at once')
+    parser.add_argument('--tags', type=str, default=string.ascii_letters, help='characters that may fill the blanks')
+    inference.add_arguments(parser)
+    parser.add_argument('ckpt_path')
+    parser.add_argument('paragraphs', nargs='+', help='files with paragraphs with blank tags', type=Path)
+    args = parser.parse_args()
+
+    device = args.device
+    inference.setup(args)
+
+    checkpoint = checkpoints.load(args.ckpt_path)
+    gptconf = GPTConfig(**checkpoint['model_args'])
+    if args.lora:
+        model = GPT(gptconf)
+        from lora import gpt2_peft_config, lora_find_and_replace
+        lora_find_and_replace(model, gpt2_peft_config)
+        model.load_state_dict(checkpoint['model'])
+    else:
+        model = checkpoints.build_model(gptconf, checkpoint['model'])
+    model.eval()
+    model.to(device)
+
+    sp = spm.SentencePieceProcessor(model_file=args.spm)
+    tag_ids = tag_token_ids(sp, args.tags)
+
+    prompts = [p.strip() for f in args.paragraphs for p in f.read_text().split("\n\n")]
+    prefix = [] if args.no_eot else [50256]
+    sequences = [prefix + sp.encode(prompt) for prompt in prompts]
+
+    # decode paragraphs of similar lengths together, longer ones than the model can see stay blank
+    order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+    too_long = [i for i in order if len(sequences[i]) > model.config.block_size]
+    for i in too_long:
+        print(f'WARNING: paragraph {i} has {len(sequences[i])} tokens, more than block_size, leaving it blank', file=sys.stderr)
+    order = [i for i in order if len(sequences[i]) <= model.config.block_size]
+
+    throughput = inference.Throughput(device)
+    filled = list(sequences)
+    for k in range(0, len(order), args.batch_size):
+        batch = order[k:k+args.batch_size]
+        for i, tokens in zip(batch, decode_tags(model, [sequences[i] for i in batch], tag_ids,
+                                                autocast=lambda: inference.autocast(device))):
+            filled[i] = tokens
+        throughput.add(sum(len(sequences[i]) for i in batch))
+
+    for tokens in filled:
+        print(sp.decode(tokens[len(prefix):]))
+        print(flush=True)
+
+    throughput.report()
@@ -29,6 +29,10 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from documents import Documents
+from loader import BatchLoader
+from checkpoints import adapter_state_dict, base_reference
+from checkpoint_writer import CheckpointWriter
 from lora import lora_find_and_replace, mark_only_lora_as_trainable, gpt2_peft_config, print_trainable_parameters
 
 
@@ -57,12 +61,17 @@ def construct_path_suffix(
 # default config values designed to train a gpt2 (124M) on OpenWebText
 # I/O
 init = str(Path.home() / "gpt/exp/uk4b_medium/ckpt.pt")
+init_from = "init"  # 'init' starts a new run from the init checkpoint, 'resume' continues from ckpt_path when it exists
 ckpt_path = "exp/gec_medium/ckpt.pt"
 eval_interval = 100
 log_interval = 1  # as many as grad acc steps
 eval_iters = 200
+eval_full_val = False  # sweep all of valid_bin in non-overlapping windows on all ranks instead of eval_iters random batches
+eval_train = True  # also estimate the train loss from eval_iters random batches
 eval_only = False  # if True, script exits right after the first eval
 always_save_checkpoint = True  # if True, always save a checkpoint after each eval
+save_adapter_only = True  # save the trainable LoRA weights with a reference to init instead of the whole model
+keep_checkpoints = 3  # also keep this many recent checkpoints as <ckpt_path stem>.step<iter>.pt, 1 keeps only ckpt_path
 # wandb logging
 wandb_log = True  # disabled by default
 wandb_project = "gecbot"
@@ -71,6 +80,9 @@ wandb_run_name = "lora"  # 'run' + str(time.time())
 gradient_accumulation_steps = 2  # used to simulate larger batch sizes
 batch_size = 4  # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+prefetch = 2  # batches to prepare ahead of the training loop on a background thread
+align_documents = False  # start every window at a document, needs the .bin.idx index written by prepare
+loss_chunk_size = 0  # compute the loss this many positions at a time without materializing the logits, 0 to disable
 train_bin = "gec_train_wiki.bin"
 valid_bin = "gec_valid_wiki.bin"
 # model
@@ -109,7 +121,9 @@ ckpt_suffix = construct_path_suffix(
     config,
     base_config,
     always_include=["init"],
-    always_ignore=["ckpt_path", "train_bin", "valid_bin", "wandb_log", "wandb_project", "wandb_run_name", "compile"],
+    always_ignore=["init_from", "save_adapter_only", "keep_checkpoints", "ckpt_path", "train_bin", "valid_bin", "wandb_log", "wandb_project", "wandb_run_name", "compile",
+                   # throughput and evaluation settings, a run resumed with other values is still the same run
+                   "prefetch", "align_documents", "loss_chunk_size", "eval_full_val", "eval_train"],
 )
 ckpt_path = ckpt_path.parent / f"{ckpt_path.stem}__{ckpt_suffix}{ckpt_path.suffix}"
 print(f"Saving checkpoint to {ckpt_path}")
@@ -121,6 +135,7 @@ if ddp:
     init_process_group(backend=backend)
     ddp_rank = int(os.environ["RANK"])
     ddp_local_rank = int(os.environ["LOCAL_RANK"])
+    ddp_world_size = int(os.environ["WORLD_SIZE"])
     device = f"cuda:{ddp_local_rank}"
     torch.cuda.set_device(device)
     master_process = ddp_rank == 0  # this process will do logging, checkpointing etc.
@@ -129,6 +144,8 @@ else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank = 0
+    ddp_world_size = 1
 
 if master_process:
     ckpt_path.parent.mkdir(parents=True, exist_ok=True)
@@ -144,20 +161,29 @@ ctx = nullcontext() if device_type == "cpu" else torch.amp.autocast(device_type=
 train_data = np.memmap(train_bin, dtype=np.uint16, mode="r")
 val_data = np.memmap(valid_bin, dtype=np.uint16, mode="r")
 
-
+# continue the run of ckpt_path: model, optimizer, scaler, iteration and the data and random streams of every rank
+resume = None
+if init_from == "resume" and ckpt_path.exists():
+    print(f"Resuming training from {ckpt_path}")
+    resume = torch.load(ckpt_path, map_location="cpu")  # generator states have to stay on the cpu
+rank_resume = None
+if resume is not None and len(resume.get("ranks", [])) == ddp_world_size:
+    rank_resume = resume["ranks"][ddp_rank]
+elif resume is not None:
+    print(f"WARNING: {ckpt_path} has no data streams for {ddp_world_size} ranks, drawing new batches")
+
+loaders = {
+    "train": BatchLoader(train_data, batch_size, block_size, device, prefetch=prefetch,
+                         starts=Documents(train_bin).starts(block_size) if align_documents else None,
+                         state=rank_resume["loaders"]["train"] if rank_resume else None),
+    "val": BatchLoader(val_data, batch_size, block_size, device, prefetch=prefetch,
+                       starts=Documents(valid_bin).starts(block_size) if align_documents else None,
+                       state=rank_resume["loaders"]["val"] if rank_resume else None),
+}
 
 
 def get_batch(split):
-    data = train_data if split == "train" else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i : i + block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i + 1 : i + 1 + block_size]).astype(np.int64)) for i in ix])
-    if device_type == "cuda":
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
+    return loaders[split].next()
 
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
@@ -169,8 +195,7 @@ model_args = dict(
     n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size, bias=bias, vocab_size=None, dropout=dropout
 )  # start with model_args from command line
 
-print(f"Resuming training from a checkpoint")
-# resume training from a checkpoint.
+print(f"Initializing from {init}")
 checkpoint = torch.load(init, map_location=device)
 checkpoint_model_args = checkpoint["model_args"]
 # force these config attributes to be equal otherwise we can't even resume training
@@ -211,12 +236,26 @@ scaler = torch.cuda.amp.GradScaler(enabled=(dtype == "float16"))
 lora_find_and_replace(model, gpt2_peft_config)
 mark_only_lora_as_trainable(model, gpt2_peft_config.bias)
 print_trainable_parameters(model)
+if resume is not None:
+    state_dict = resume["model"]
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix) :]] = state_dict.pop(k)
+    model.load_state_dict(state_dict, strict="base" not in resume)  # adapter checkpoints, the rest is init
 model.to(device)
 
 # optimizer
 optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
-if False and init_from == "resume":
-    optimizer.load_state_dict(checkpoint["optimizer"])
+if resume is not None:
+    optimizer.load_state_dict(resume["optimizer"])
+    if "scaler" in resume:
+        scaler.load_state_dict(resume["scaler"])
+    # the learning rate schedule follows from iter_num
+    iter_num = resume["iter_num"]
+    best_val_loss = resume["best_val_loss"]
+checkpoint = None  # free up memory
+# checkpoints refer to the weights they share with init by its content hash
+base = base_reference(init) if save_adapter_only and master_process else None
 
 # compile the model
 if compile:
@@ -230,21 +269,64 @@ if ddp:
 
 # helps estimate an arbitrarily accurate loss over either split using many batches
 @torch.no_grad()
-def estimate_loss():
+def estimate_loss(splits=("train", "val")):
     out = {}
     model.eval()
-    for split in ["train", "val"]:
+    for split in splits:
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
             X, Y = get_batch(split)
             with ctx:
-                logits, loss = model(X, labels=Y)
+                logits, loss = model(X, labels=Y, loss_chunk_size=loss_chunk_size)
             losses[k] = loss.item()
         out[split] = losses.mean()
     model.train()
     return out
 
 
+# the windows of the full validation pass: every target token of valid_bin once, split between the ranks
+val_windows = np.arange(0, len(val_data) - block_size, block_size)[ddp_rank::ddp_world_size]
+val_offsets = np.arange(block_size + 1)
+
+
+@torch.no_grad()
+def full_val_loss():
+    "token-weighted loss over all validation windows, the same on every rank and in every run"
+    raw_model = model.module if ddp else model  # ranks forward different numbers of batches, no DDP syncs
+    raw_model.eval()
+    totals = torch.zeros(2, dtype=torch.float64, device=device)  # loss sum, tokens
+    for k in range(0, len(val_windows), batch_size):
+        xy = torch.from_numpy(val_data[val_windows[k : k + batch_size, None] + val_offsets].astype(np.int64))
+        xy = xy.pin_memory().to(device, non_blocking=True) if device_type == "cuda" else xy.to(device)
+        X, Y = xy[:, :-1], xy[:, 1:]
+        with ctx:
+            logits, loss = raw_model(X, labels=Y, loss_chunk_size=loss_chunk_size)
+        totals[0] += loss.double() * Y.numel()
+        totals[1] += Y.numel()
+    if ddp:
+        torch.distributed.all_reduce(totals)
+    raw_model.train()
+    return (totals[0] / totals[1]).item()
+
+
+def rank_state():
+    "random generators of this rank and the batch it holds, enough to continue its exact stream of batches"
+    return {
+        "rng": torch.get_rng_state(),
+        "cuda_rng": torch.cuda.get_rng_state(device) if device_type == "cuda" else None,
+        "loaders": {split: loader.state_dict() for split, loader in loaders.items()},
+        "batch": (X.cpu(), Y.cpu()),
+    }
+
+
+def gather_rank_states():
+    if not ddp:
+        return [rank_state()]
+    states = [None] * ddp_world_size
+    torch.distributed.all_gather_object(states, rank_state())
+    return states
+
+
 # learning rate decay scheduler (cosine with warmup)
 def get_lr(it):
     # 1) linear warmup for warmup_iters steps
@@ -266,8 +348,20 @@ if wandb_log and master_process:
 
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 
+# checkpoints are written on a background thread, training continues once they are copied to host memory
+checkpoint_writer = CheckpointWriter(keep=keep_checkpoints)
+
 # training loop
-X, Y = get_batch("train")  # fetch the very first batch
+if rank_resume is not None:
+    # the batch this rank was about to train on and the generators as they were when the checkpoint was taken
+    X, Y = (t.to(device) for t in rank_resume["batch"])
+    torch.set_rng_state(rank_resume["rng"])
+    if rank_resume["cuda_rng"] is not None and device_type == "cuda":
+        torch.cuda.set_rng_state(rank_resume["cuda_rng"], device)
+else:
+    X, Y = get_batch("train")  # fetch the very first batch
+resume_iter = iter_num if resume is not None else None  # evaluated right before the checkpoint, no need to repeat
+resume = rank_resume = None
 t0 = time.time()
 while True:
 
@@ -277,14 +371,23 @@ while True:
         param_group["lr"] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
-    if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+    evaluate = iter_num % eval_interval == 0 and iter_num != resume_iter
+    if evaluate:
+        # other ranks wait for the evaluation and stay where they are, the master collects their state beforehand
+        ranks = gather_rank_states()
+        if eval_full_val:
+            val_loss = full_val_loss()
+    if evaluate and master_process:
+        losses = estimate_loss((["train"] if eval_train else []) + ([] if eval_full_val else ["val"]))
+        if eval_full_val:
+            losses["val"] = val_loss
+        train_loss = f"train loss {losses['train']:.4f}, " if eval_train else ""
+        print(f"step {iter_num}: {train_loss}val loss {losses['val']:.4f}")
         if wandb_log:
             wandb.log(
                 {
                     "iter": iter_num,
-                    "train/loss": losses["train"],
+                    **({"train/loss": losses["train"]} if eval_train else {}),
                     "val/loss": losses["val"],
                     "lr": lr,
                 }
@@ -294,16 +397,21 @@ while True:
                 best_val_loss = losses["val"]
                 raw_model = model.module if ddp else model
                 if iter_num > 0:
+                    ranks[0] = rank_state()  # past the batches drawn by the evaluation
                     checkpoint = {
-                        "model": raw_model.state_dict(),
+                        "model": adapter_state_dict(raw_model) if save_adapter_only else raw_model.state_dict(),
                         "optimizer": optimizer.state_dict(),
+                        "scaler": scaler.state_dict(),
                         "model_args": model_args,
                         "iter_num": iter_num,
                         "best_val_loss": best_val_loss,
                         "config": config,
+                        "ranks": ranks,
                     }
+                    if save_adapter_only:
+                        checkpoint["base"] = base
                     print(f"saving checkpoint to {ckpt_path}")
-                    torch.save(checkpoint, str(ckpt_path))
+                    checkpoint_writer.save(checkpoint, ckpt_path, step=iter_num)
         else:
             print("NaN loss detected")
             break
@@ -320,7 +428,7 @@ while True:
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = micro_step == gradient_accumulation_steps - 1
         with ctx:
-            logits, loss = model(X, labels=Y)
+            logits, loss = model(X, labels=Y, loss_chunk_size=loss_chunk_size)
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
         X, Y = get_batch("train")
         # backward pass, with gradient scaling if training in fp16
@@ -346,12 +454,14 @@ while True:
     t0 = t1
     if iter_num % log_interval == 0 and master_process:
         lossf = loss.item()  # loss as float. note: this is a CPU-GPU sync point
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, lr={lr:.6f}")
+        data_wait = loaders["train"].pop_wait()
+        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, data wait {data_wait*1000:.2f}ms, lr={lr:.6f}")
     iter_num += 1
 
     # termination conditions
     if iter_num > max_iters:
         break
 
+checkpoint_writer.wait()
 if ddp:
     destroy_process_group()
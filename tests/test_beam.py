@@ -0,0 +1,78 @@
+from argparse import Namespace
+from contextlib import nullcontext
+
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model import GPTConfig, GPT
+import beam
+import inference
+
+
+class Tokens:
+    "stands in for the sentencepiece model beam() prints its outputs with"
+    def decode(self, ids):
+        return ' '.join(map(str, ids))
+
+
+@pytest.fixture(autouse=True)
+def fp32(monkeypatch):
+    # compare the decoding algorithms, not the rounding of bf16 autocast on CPU
+    monkeypatch.setattr(inference, 'autocast', lambda *args, **kwargs: nullcontext())
+    monkeypatch.setattr(beam, 'sp', Tokens(), raising=False)
+
+
+def tiny_model():
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(block_size=32, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True))
+    with torch.no_grad():
+        model.transformer.wte.weight.mul_(50) # peaky distributions, beams rarely tie
+    model.eval()
+    return model
+
+
+def decode_args(**kwargs):
+    return Namespace(**(dict(device='cpu', beam=3, length_penalty=0.0, eval_len=8, repetition_penalty=1.0,
+                             no_repeat_ngram_size=2, min_length=0, no_kv_cache=False, seq_len=16) | kwargs))
+
+
+def batch(queries, ids, left_pad=False):
+    if left_pad:
+        query = pad_sequence([q.flip(0) for q in queries], batch_first=True, padding_value=63).flip(1)
+    else:
+        query = torch.stack(queries)
+    return {'query': query, 'query_len': torch.LongTensor([len(q) for q in queries]), 'id': torch.LongTensor(ids)}
+
+
+def test_prefix_cache_matches_concatenated_context():
+    model = tiny_model()
+    torch.manual_seed(1)
+    context = torch.randint(63, (6,))
+    queries = [torch.randint(63, (n,)) for n in (5, 3, 4)]
+    args = decode_args()
+
+    cached = beam.beam(model, [batch(queries, [0, 1, 2], left_pad=True)], args, eos_token_id=[0], context=context)
+    for i, query in enumerate(queries):
+        full = beam.beam(model, [batch([torch.cat((context, query))], [i])], args, eos_token_id=[0])
+        assert cached[i]['predict'] == full[i]['predict']
+
+
+@pytest.mark.parametrize('length_penalty', [0.0, 1.0])
+def test_early_stop_matches_exhaustive_beam(monkeypatch, length_penalty):
+    model = tiny_model()
+    torch.manual_seed(1)
+    queries = [torch.randint(63, (4,)) for _ in range(4)]
+    data = [batch(queries, [0, 1, 2, 3])]
+    args = decode_args(length_penalty=length_penalty, eval_len=12)
+    eos_token_id = list(range(0, 63, 5)) # hypotheses finish at different steps
+
+    stopped = beam.beam(model, data, args, eos_token_id=eos_token_id)
+
+    add_beam_candidate = beam._add_beam_candidate
+    def never_done(*args, **kwargs):
+        return add_beam_candidate(*args, **kwargs) & False
+    monkeypatch.setattr(beam, '_add_beam_candidate', never_done)
+    exhaustive = beam.beam(model, data, args, eos_token_id=eos_token_id)
+
+    assert stopped == exhaustive
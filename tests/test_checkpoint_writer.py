@@ -0,0 +1,42 @@
+import os
+
+import pytest
+import torch
+
+from checkpoint_writer import CheckpointWriter
+
+
+def test_keeps_the_most_recent_steps(tmp_path):
+    path = tmp_path / 'ckpt.pt'
+    writer = CheckpointWriter(keep=2)
+    weight = torch.zeros(4)
+    for step in (3, 6, 9, 12):
+        weight.fill_(step) # the writer snapshots the tensor, later updates do not reach the file
+        writer.save({'model': {'weight': weight}, 'iter_num': step}, path, step=step)
+    writer.wait()
+
+    kept = sorted(p.name for p in tmp_path.glob('ckpt.step*.pt'))
+    assert kept == ['ckpt.step0000009.pt', 'ckpt.step0000012.pt']
+    assert not list(tmp_path.glob('*.tmp'))
+    for name, step in zip(kept, (9, 12)):
+        checkpoint = torch.load(tmp_path / name)
+        assert checkpoint['iter_num'] == step and torch.equal(checkpoint['model']['weight'], torch.full((4,), float(step)))
+    assert os.path.samefile(path, tmp_path / kept[-1])
+
+
+def test_shared_tensors_stay_shared(tmp_path):
+    path = tmp_path / 'ckpt.pt'
+    weight = torch.randn(4, 4)
+    writer = CheckpointWriter()
+    writer.save({'wte': weight, 'lm_head': weight}, path)
+    writer.wait()
+    checkpoint = torch.load(path)
+    assert checkpoint['wte'].data_ptr() == checkpoint['lm_head'].data_ptr()
+
+
+def test_write_errors_surface_in_wait(tmp_path):
+    writer = CheckpointWriter()
+    writer.save({'weight': torch.zeros(1)}, tmp_path / 'missing' / 'ckpt.pt')
+    with pytest.raises(RuntimeError, match='does not exist'):
+        writer.wait()
+    writer.wait() # reported once
@@ -0,0 +1,63 @@
+import dataclasses
+
+import pytest
+import torch
+
+from model import GPTConfig, GPT
+import checkpoints
+
+
+def tiny_config(**kwargs):
+    return GPTConfig(**(dict(block_size=16, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True) | kwargs))
+
+
+@torch.no_grad()
+def test_merge_lora_matches_unmerged_forward():
+    pytest.importorskip('peft')
+    from lora import gpt2_peft_config, lora_find_and_replace
+    from merge_lora import merge_lora
+
+    torch.manual_seed(1337)
+    model = GPT(tiny_config())
+    lora_find_and_replace(model, gpt2_peft_config)
+    for name, p in model.named_parameters():
+        if 'lora_' in name:
+            p.normal_(std=0.1) # lora_B starts at zero, which would merge trivially
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    model.eval()
+
+    merged = checkpoints.build_model(tiny_config(), merge_lora(state_dict, lora_alpha=gpt2_peft_config.lora_alpha))
+    merged.eval()
+    x = torch.randint(64, (2, 16))
+    assert torch.allclose(merged(x, decode_full=True)[0], model(x, decode_full=True)[0], atol=1e-4)
+
+
+@torch.no_grad()
+def test_adapter_checkpoint_composes_with_cropped_base(tmp_path):
+    torch.manual_seed(1337)
+    base = GPT(tiny_config())
+    base_path = tmp_path / 'base.pt'
+    torch.save({'model': base.state_dict(), 'model_args': dataclasses.asdict(base.config)}, base_path)
+
+    # a run with a smaller block_size that trains the final layer norm only
+    model = GPT(tiny_config())
+    model.load_state_dict(torch.load(base_path)['model'])
+    model.crop_block_size(8)
+    for name, p in model.named_parameters():
+        p.requires_grad = name.startswith('transformer.ln_f')
+    model.transformer.ln_f.weight.add_(torch.randn_like(model.transformer.ln_f.weight))
+    model.eval()
+
+    adapter_path = tmp_path / 'adapter.pt'
+    torch.save({
+        'model': checkpoints.adapter_state_dict(model),
+        'model_args': dataclasses.asdict(tiny_config(block_size=8)),
+        'base': checkpoints.base_reference(base_path),
+    }, adapter_path)
+    assert set(torch.load(adapter_path)['model']) == {'transformer.ln_f.weight', 'transformer.ln_f.bias'}
+
+    checkpoint = checkpoints.load(adapter_path, verify=True)
+    composed = checkpoints.build_model(GPTConfig(**checkpoint['model_args']), checkpoint['model'])
+    composed.eval()
+    x = torch.randint(64, (2, 8))
+    assert torch.allclose(composed(x, decode_full=True)[0], model(x, decode_full=True)[0], atol=1e-5)
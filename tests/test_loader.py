@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from loader import BatchLoader
+
+
+def test_cpu_batches_are_not_overwritten():
+    data = np.arange(1000, dtype=np.uint16)
+    loader = BatchLoader(data, 1, 8, 'cpu', prefetch=2)
+    x, y = loader.next()
+    expected = x.clone()
+    for _ in range(10): # the fill thread cycles through all buffers
+        loader.next()
+    assert torch.equal(x, expected)
+    assert torch.equal(y, expected + 1)
+
+
+def test_state_continues_the_stream():
+    data = np.arange(1000, dtype=np.uint16)
+    torch.manual_seed(1337)
+    loader = BatchLoader(data, 4, 8, 'cpu', prefetch=2)
+    for _ in range(3):
+        loader.next()
+    state = loader.state_dict()
+    expected = [loader.next()[0] for _ in range(2)]
+
+    resumed = BatchLoader(data, 4, 8, 'cpu', prefetch=2, state=state)
+    for x in expected:
+        assert torch.equal(resumed.next()[0], x)
@@ -0,0 +1,22 @@
+import torch
+
+from logits_processors import enforce_repetition_penalty_
+
+
+def reference_repetition_penalty(scores, history, repetition_penalty):
+    "the per-row loop of the CTRL repetition penalty"
+    for i in range(scores.size(0)):
+        for previous_token in set(history[i].tolist()):
+            if scores[i, previous_token] < 0:
+                scores[i, previous_token] *= repetition_penalty
+            else:
+                scores[i, previous_token] /= repetition_penalty
+    return scores
+
+
+def test_repetition_penalty_matches_reference_loop():
+    torch.manual_seed(1337)
+    scores = torch.randn(4, 32)
+    history = torch.randint(8, (4, 12)) # plenty of repeated tokens
+    expected = reference_repetition_penalty(scores.clone(), history, 1.3)
+    assert torch.allclose(enforce_repetition_penalty_(scores, history, 1.3), expected)
@@ -0,0 +1,55 @@
+import torch
+
+from model import GPTConfig, GPT
+
+
+def tiny_model(**kwargs):
+    torch.manual_seed(1337)
+    config = dict(block_size=16, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True)
+    model = GPT(GPTConfig(**(config | kwargs)))
+    model.eval()
+    return model
+
+
+@torch.no_grad()
+def test_kv_cache_matches_full_forward():
+    model = tiny_model()
+    x = torch.randint(64, (2, 10))
+    full, _ = model(x, decode_full=True)
+
+    logits, _, past = model(x[:, :4], decode_full=True, past=None, use_cache=True)
+    assert torch.allclose(logits, full[:, :4], atol=1e-5)
+    for t in range(4, 10):
+        logits, _, past = model(x[:, t:t+1], past=past, use_cache=True)
+        assert torch.allclose(logits[:, 0], full[:, t], atol=1e-5)
+
+
+@torch.no_grad()
+def test_left_padding_matches_unpadded():
+    model = tiny_model()
+    long, short = torch.randint(64, (1, 8)), torch.randint(64, (1, 5))
+    x = torch.cat((torch.full((1, 3), 63), short), dim=1)
+    x = torch.cat((long, x))
+    mask = torch.ones_like(x, dtype=torch.bool)
+    mask[1, :3] = False
+
+    padded, _, past = model(x, attention_mask=mask, decode_full=True, use_cache=True)
+    assert torch.allclose(padded[0], model(long, decode_full=True)[0][0], atol=1e-5)
+    assert torch.allclose(padded[1, 3:], model(short, decode_full=True)[0][0], atol=1e-5)
+
+    # continuing both rows against the cache keeps the padding invisible
+    step = torch.randint(64, (2, 1))
+    mask = torch.cat((mask, torch.ones_like(step, dtype=torch.bool)), dim=1)
+    logits, _, _ = model(step, attention_mask=mask, past=past, use_cache=True)
+    assert torch.allclose(logits[0], model(torch.cat((long, step[:1]), dim=1))[0][0], atol=1e-5)
+    assert torch.allclose(logits[1], model(torch.cat((short, step[1:]), dim=1))[0][0], atol=1e-5)
+
+
+@torch.no_grad()
+def test_chunked_loss_matches_full_logits():
+    model = tiny_model()
+    x, y = torch.randint(64, (2, 12)), torch.randint(64, (2, 12))
+    y[0, :3] = -1
+    _, loss = model(x, labels=y)
+    _, chunked = model(x, labels=y, loss_chunk_size=5)
+    assert torch.allclose(loss, chunked, atol=1e-5)
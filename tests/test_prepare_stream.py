@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+import sentencepiece as spm
+
+from documents import Documents
+from prepare_stream import Tok, paragraphs, prepare
+
+spm_path = str(Path(__file__).resolve().parent.parent / 'examples' / 'wiki.model')
+texts = [
+    'Перший абзац.\nДругий рядок першого абзацу.\n\nДругий абзац.\n\n\n\nТретій після порожніх рядків.\n',
+    '\n\nАбзац файлу, що починається з порожніх рядків.\n\n\n',
+]
+
+
+@pytest.fixture
+def txt(tmp_path):
+    paths = []
+    for i, text in enumerate(texts):
+        path = tmp_path / f'{i}.txt'
+        path.write_text(text, encoding='utf-8')
+        paths.append(str(path))
+    return paths
+
+
+def expected_paragraphs():
+    return [p for text in texts for p in text.split('\n\n') if p]
+
+
+@pytest.mark.parametrize('block_size', [5, 1<<20]) # paragraphs split across reads and read at once
+def test_paragraphs_skip_empty_lines(txt, block_size):
+    assert list(paragraphs(txt, block_size=block_size)) == expected_paragraphs()
+
+
+def test_prepare_writes_every_paragraph_as_a_document(txt, tmp_path):
+    bin = str(tmp_path / 'train.bin')
+    prepare(txt, bin, num_proc=2, chunk_size=2, model_file=spm_path)
+
+    sp = spm.SentencePieceProcessor(model_file=spm_path)
+    docs = Documents(bin)
+    assert [docs[i].tolist() for i in range(len(docs))] == [sp.encode(p) + [Tok.endoftext] for p in expected_paragraphs()]
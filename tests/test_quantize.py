@@ -0,0 +1,22 @@
+import dataclasses
+
+import torch
+
+from model import GPTConfig, GPT
+import checkpoints
+from quantize import quantize, load_quantized
+
+
+@torch.no_grad()
+def test_quantized_checkpoint_reloads(tmp_path):
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(block_size=16, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True))
+    model.eval()
+    qmodel = quantize(model)
+    path = tmp_path / 'int8.pt'
+    torch.save({'model': qmodel.state_dict(), 'model_args': dataclasses.asdict(model.config), 'quantized': 'dynamic_int8'}, path)
+
+    reloaded = load_quantized(checkpoints.load(path))
+    reloaded.eval()
+    x = torch.randint(64, (2, 16))
+    assert torch.equal(reloaded(x, decode_full=True)[0], qmodel(x, decode_full=True)[0])
@@ -0,0 +1,59 @@
+import dataclasses
+from pathlib import Path
+import re
+import subprocess
+import sys
+
+import pytest
+import sentencepiece as spm
+import torch
+from torch.nn import functional as F
+
+from model import GPTConfig, GPT
+
+examples = Path(__file__).resolve().parent.parent / 'examples'
+spm_path = examples / 'wiki.model'
+text = 'Київ є столицею та найбільшим містом України, він розташований на обох берегах Дніпра.'
+
+
+@pytest.fixture(scope='module')
+def ckpt_path(tmp_path_factory):
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(block_size=64, vocab_size=50304, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True))
+    path = tmp_path_factory.mktemp('score') / 'ckpt.pt'
+    torch.save({'model': model.state_dict(), 'model_args': dataclasses.asdict(model.config)}, path)
+    return path
+
+
+def total_nll(ckpt_path, *flags):
+    score = subprocess.run([sys.executable, examples / 'score.py', '--device', 'cpu', '--spm', spm_path, *flags, ckpt_path, text],
+                           check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return float(re.search(r'total nll (\S+) over', score.stderr).group(1))
+
+
+@torch.no_grad()
+def reference_nll(ckpt_path, seq_len):
+    "every target scored by a forward pass over the seq_len - 1 tokens before it, or all of them"
+    checkpoint = torch.load(ckpt_path)
+    model = GPT(GPTConfig(**checkpoint['model_args']))
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+    x = torch.tensor([50256] + spm.SentencePieceProcessor(model_file=str(spm_path)).encode(text))
+    assert x.size(0) > seq_len
+    nll = 0.
+    for t in range(1, x.size(0)):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            y, _ = model(x[None, max(0, t - seq_len + 1):t], decode_full=True)
+        nll += F.cross_entropy(y[0, -1], x[t]).item()
+    return nll
+
+
+def test_strided_matches_full_windows(ckpt_path):
+    seq_len = 8
+    strided = total_nll(ckpt_path, '--seq_len', str(seq_len), '--stride', '1')
+    assert strided == pytest.approx(reference_nll(ckpt_path, seq_len), rel=1e-3)
+
+
+@pytest.mark.parametrize('flags', [['--seq_len', '64'], ['--seq_len', '16', '--stride', '4']])
+def test_chunk_size_keeps_the_numbers(ckpt_path, flags):
+    assert total_nll(ckpt_path, *flags, '--chunk_size', '3') == pytest.approx(total_nll(ckpt_path, *flags), rel=1e-4)
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from model import GPTConfig, GPT
+import speculative
+
+
+def tiny_model(seed, **kwargs):
+    torch.manual_seed(seed)
+    config = dict(block_size=32, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True)
+    model = GPT(GPTConfig(**(config | kwargs)))
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize('steps', [20, 40]) # 40 slides the window past block_size
+def test_greedy_speculative_matches_generate(steps):
+    target, draft = tiny_model(1337), tiny_model(1, n_layer=1)
+    torch.manual_seed(0)
+    idx = torch.randint(64, (1, 5))
+    stats = {}
+    output = speculative.generate(target, draft, idx, steps, k=4, top_k=1, stats=stats)
+    with torch.no_grad():
+        expected = target.generate(idx, steps, top_k=1)
+    assert torch.equal(output, expected)
+    assert 0 < stats['accepted'] < stats['drafted'] # both accepted and rejected drafts
@@ -0,0 +1,57 @@
+import torch
+
+from model import GPTConfig, GPT
+from tagger import decode_slots, decode_tags
+
+blank, pad = 60, 63
+tag_ids = [10, 11, 12, 13]
+
+
+def reference_decode(model, tokens):
+    "fill every blank with the best tag given a full forward pass over the filled tokens before it"
+    filled = []
+    for token in tokens:
+        if token == blank:
+            logits, _ = model(torch.tensor([filled]))
+            token = tag_ids[logits[0, -1, tag_ids].argmax().item()]
+        filled.append(token)
+    return filled
+
+
+@torch.no_grad()
+def test_batched_tags_match_per_slot_greedy_decoding():
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(block_size=32, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True))
+    model.eval()
+
+    sequences = []
+    for length, slots in [(12, 3), (20, 5), (7, 1), (9, 0), (16, 4)]:
+        tokens = torch.randint(50, (length,)).tolist()
+        for i in torch.randperm(length - 1)[:slots].tolist():
+            tokens[i + 1] = blank # never the first token, there is nothing to condition on
+        sequences.append(tokens)
+
+    assert decode_tags(model, sequences, tag_ids, blank=blank, pad=pad) == [reference_decode(model, s) for s in sequences]
+
+
+def sequential_decode(model, segments):
+    "the ner.py decoder for sentences longer than block_size: a cache per sentence, a forward pass per slot"
+    tags, past = [], None
+    for segment in segments:
+        logits, _, past = model(torch.tensor([tags[-1:] + segment]), past=past, use_cache=True)
+        tags.append(logits[0, -1].argmax().item())
+    return tags
+
+
+@torch.no_grad()
+def test_batched_slots_match_sequential_decoding_under_autocast():
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(block_size=64, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True))
+    model.transformer.wte.weight.mul_(50) # peaky distributions, bf16 rounding does not flip the argmax
+    model.eval()
+
+    segments = [[torch.randint(64, (n,)).tolist() for n in lengths] for lengths in [(9, 2, 3, 1), (5, 1), (12, 2, 2, 4, 1, 3), (3,)]]
+    autocast = lambda: torch.autocast('cpu', dtype=torch.bfloat16)
+    with autocast():
+        expected = [sequential_decode(model, s) for s in segments]
+    assert decode_slots(model, segments, pad=pad, autocast=autocast) == expected
@@ -0,0 +1,66 @@
+import dataclasses
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+from model import GPTConfig, GPT
+
+examples = Path(__file__).resolve().parent.parent / 'examples'
+
+
+@pytest.fixture
+def data(tmp_path):
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(block_size=16, vocab_size=64, n_layer=2, n_head=2, n_embd=16, dropout=0.0, bias=True))
+    torch.save({'model': model.state_dict(), 'model_args': dataclasses.asdict(model.config)}, tmp_path / 'init.pt')
+    rng = np.random.default_rng(1337)
+    for split in ('train', 'valid'):
+        rng.integers(64, size=500).astype(np.uint16).tofile(tmp_path / f'{split}.bin')
+    return tmp_path
+
+
+def train(data, run, *flags):
+    "train.py in examples/, it reads configurator.py from the working directory, returns the kept checkpoints"
+    subprocess.run([sys.executable, 'train.py', '--device=cpu', '--dtype=float32', '--compile=False', '--wandb_log=False',
+                    '--block_size=8', '--batch_size=2', '--gradient_accumulation_steps=2', '--eval_iters=2', '--eval_interval=3',
+                    '--max_iters=7', '--warmup_iters=2', '--lr_decay_iters=7', '--learning_rate=0.01', '--keep_checkpoints=5',
+                    f'--init={data / "init.pt"}', f'--train_bin={data / "train.bin"}', f'--valid_bin={data / "valid.bin"}',
+                    f'--ckpt_path={data / run / "ckpt.pt"}', *flags],
+                   cwd=examples, check=True, stdout=subprocess.DEVNULL)
+    return sorted((data / run).glob('ckpt__*.step*.pt'))
+
+
+def assert_same(a, b):
+    if torch.is_tensor(a):
+        assert torch.equal(a, b)
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for k in a:
+            assert_same(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same(x, y)
+    else:
+        assert a == b
+
+
+def test_resume_continues_the_run(data):
+    pytest.importorskip('peft')
+    step3, step6 = train(data, 'full')
+    assert step3.name.endswith('.step0000003.pt') and step6.name.endswith('.step0000006.pt')
+
+    # interrupted after the checkpoint of step 3
+    (data / 'resumed').mkdir()
+    shutil.copyfile(step3, data / 'resumed' / step3.name.replace('.step0000003', ''))
+    resumed = train(data, 'resumed', '--init_from=resume')
+    assert [p.name for p in resumed] == [step6.name]
+
+    expected, actual = torch.load(step6, weights_only=False), torch.load(resumed[0], weights_only=False)
+    for key in ('model', 'optimizer', 'iter_num', 'best_val_loss', 'ranks'):
+        assert_same(actual[key], expected[key])
@@ -29,6 +29,8 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from loader import BatchLoader
+from checkpoint_writer import CheckpointWriter
 from mlm import mask_tokens
 
 # -----------------------------------------------------------------------------
@@ -40,6 +42,7 @@ log_interval = 1 # as many as grad acc steps
 eval_iters = 200
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = False # if True, always save a checkpoint after each eval
+keep_checkpoints = 3 # also keep this many recent checkpoints as ckpt.step<iter>.pt, 1 keeps only ckpt.pt
 init_from = 'resume' # 'scratch' or 'resume' or 'gpt2*'
 reset_steps = False # start counting steps from 0
 # wandb logging
@@ -51,6 +54,7 @@ dataset = 'uk4b'
 gradient_accumulation_steps = 32 # used to simulate larger batch sizes
 batch_size = 16 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+prefetch = 2 # batches to prepare ahead of the training loop on a background thread
 base_seed = 1339
 # model
 n_layer = 12
@@ -111,17 +115,13 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 data_dir = os.path.join('data', dataset)
 train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
 val_data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
+loaders = {
+    'train': BatchLoader(train_data, batch_size, block_size, device, prefetch=prefetch),
+    'val': BatchLoader(val_data, batch_size, block_size, device, prefetch=prefetch),
+}
 def get_batch(split):
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+    x, y = loaders[split].next()
     #x, y = mask_tokens(x)
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
     return x, y
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
@@ -242,6 +242,9 @@ if wandb_log and master_process:
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
     wandb.watch(model)
 
+# checkpoints are written on a background thread, training continues once they are copied to host memory
+checkpoint_writer = CheckpointWriter(keep=keep_checkpoints)
+
 # training loop
 X, Y = get_batch('train') # fetch the very first batch
 t0 = time.time()
@@ -293,7 +296,9 @@ while not eval_only:
     t0 = t1
     if iter_num % log_interval == 0 and master_process:
         train_loss = loss.item() # loss as float. note: this is a CPU-GPU sync point
-        print(f"iter {iter_num}: loss {train_loss:.4f}, time {dt*1000:.2f}ms, grad_norm: {grad_norm:.3f}")
+        data_wait = loaders['train'].pop_wait()
+        print(f"iter {iter_num}: loss {train_loss:.4f}, time {dt*1000:.2f}ms, data wait {data_wait*1000:.2f}ms, grad_norm: {grad_norm:.3f}")
+        log_dict["train/data_wait"] = data_wait
 
         # evaluate the loss on train/val sets and write checkpoints
         if iter_num % eval_interval == 0:
@@ -315,7 +320,7 @@ while not eval_only:
                             'config': config,
                         }
                         print(f"saving checkpoint to {out_dir}")
-                        torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                        checkpoint_writer.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'), step=iter_num)
             else:
                 print("NaN loss detected")
                 break
@@ -338,5 +343,6 @@ if eval_only and master_process:
     val_loss = estimate_loss()
     print(f"step {iter_num}: val loss {val_loss}. final eval")
 
+checkpoint_writer.wait()
 if ddp:
     destroy_process_group()